@@ -1,9 +1,114 @@
-from typing import Optional
+from typing import NamedTuple, Optional, Union
 from vtx.VtxVisitor import VtxVisitor
 from vtx.VtxParser import VtxParser
 from instructions import instruction_names
 
 MEMORY_SIZE = 2**16
+REGISTERS = {"a", "b", "c", "h", "l", "bph", "bpl", "sph", "spl", "cn"}
+CONDITIONS = {"zf", "sf", "cf", "nzf", "nsf", "ncf"}
+
+class Label(NamedTuple):
+    name: str
+
+# A line of assembly is either a label or an instruction tuple of its
+# mnemonic followed by its operands, eg. `ldr a 10` is ("ldr", "a", 10).
+# Constants are ints. Registers, m, s, cc, conditions, addresses ("@1024")
+# and label references are strs
+Line = Union[Label, tuple]
+
+def operand_kind(operand: Union[int, str]) -> str:
+    if isinstance(operand, int):
+        return "constant"
+    if operand in REGISTERS:
+        return "register"
+    if operand in CONDITIONS:
+        return "condition"
+    if operand in ("m", "s", "cc"):
+        return operand
+    if operand.startswith("@"):
+        return "address"
+    return "label"
+
+# Instruction name templates keyed by mnemonic and operand kinds.
+# A template is formatted with the upper-cased operands, eg.
+# ("ldr", "a", "spl") matches "LDR{0}{1}" and encodes as LDRASPL.
+# Constant, address and label operands are appended as bytes
+ENCODINGS: dict[tuple[str, tuple[str, ...]], str] = {
+    ("ldr", ("register", "register")): "LDR{0}{1}",
+    ("ldr", ("register", "constant")): "LDR{0}I",
+    ("ldr", ("register", "address")): "LDR{0}@",
+    ("ldr", ("register", "m")): "LDR{0}M",
+    ("str", ("address", "register")): "STR@{1}",
+    ("str", ("m", "register")): "STRM{1}",
+    ("psh", ("register",)): "PSH{0}",
+    ("psh", ("constant",)): "PSHI",
+    ("psh", ("address",)): "PSH@",
+    ("psh", ("s",)): "PSHS",
+    ("pop", ("register",)): "POP{0}",
+    ("pop", ("s",)): "POPS",
+    **{
+        (mnemonic, ("register",)): f"{mnemonic.upper()}{{0}}"
+        for mnemonic in ["add", "sub", "and", "or", "xor"]
+    },
+    **{
+        (mnemonic, ("constant",)): f"{mnemonic.upper()}I"
+        for mnemonic in ["add", "sub", "and", "or", "xor"]
+    },
+    **{
+        (mnemonic, ("address",)): f"{mnemonic.upper()}@"
+        for mnemonic in ["add", "sub", "and", "or", "xor"]
+    },
+    **{
+        (mnemonic, ("cc", "register")): f"{mnemonic.upper()}C{{1}}"
+        for mnemonic in ["add", "sub"]
+    },
+    **{
+        (mnemonic, ("cc", "constant")): f"{mnemonic.upper()}CI"
+        for mnemonic in ["add", "sub"]
+    },
+    **{
+        (mnemonic, ()): mnemonic.upper()
+        for mnemonic in ["inc", "dec", "shl", "shr"]
+    },
+    **{
+        (mnemonic, ("cc",)): f"{mnemonic.upper()}C"
+        for mnemonic in ["inc", "dec", "shl", "shr"]
+    },
+    ("jmp", ("label",)): "JI",
+    ("jmp", ("m",)): "JM",
+    ("jmp", ("condition", "label")): "J{0}I",
+    ("jmp", ("condition", "m")): "J{0}M",
+    ("cal", ("label",)): "CAL",
+    ("cal", ("address",)): "CAL",
+    ("irt", ()): "INTRET",
+    ("out", ()): "OUT",
+    ("hlt", ()): "HLT",
+}
+MNEMONICS = {mnemonic for mnemonic, _ in ENCODINGS}
+opcodes = {name: opcode for opcode, name in enumerate(instruction_names)}
+
+# Name of the instruction a line encodes as, or None if it has no encoding
+def opcode_name(line: tuple) -> Optional[str]:
+    mnemonic, *operands = line
+    template = ENCODINGS.get((mnemonic, tuple(operand_kind(operand) for operand in operands)))
+    name = template.format(*(str(operand).upper() for operand in operands)) if template else None
+    return name if name in opcodes else None
+
+# Bytes an instruction encodes to: its opcode then two for each address or
+# label operand and one for each constant
+def line_size(line: Line) -> int:
+    if isinstance(line, Label):
+        return 0
+    kinds = [operand_kind(operand) for operand in line[1:]]
+    return 1 + sum(2 if kind in ("address", "label") else kind == "constant" for kind in kinds)
+
+def format_line(line: Line) -> str:
+    if isinstance(line, Label):
+        return f"{line.name}:"
+    return " ".join(str(token) for token in line)
+
+def format_lines(lines: list[Line]) -> str:
+    return "".join(format_line(line) + "\n" for line in lines)
 
 def convert_address_to_bytes(address: int) -> tuple[int, int]:
     binary_address = bin(address)[2:].zfill(16)
@@ -16,6 +121,7 @@ class Assembler(VtxVisitor):
         self.instructions: list[int] = []
         self.label_offset: dict[str, int] = {} # map from label to its offset relative to start of program
         self.program_offset = 0 # offset from start of program
+        self.relocations: list[tuple[int, str]] = [] # (offset of address placeholder, label)
         self.start_address = start_address
         self.imports = imports
         self.exports = exports
@@ -23,37 +129,69 @@ class Assembler(VtxVisitor):
     def visitProgram(self, ctx: VtxParser.ProgramContext):
         for line in ctx.line():
             self.visit(line)
-        # Resolve jump / call names with symbol table
+        self.resolve()
+
+    # Alternative to visiting a parse tree: assemble lines that have already
+    # been parsed, eg. by FastVtxParser
+    def assemble(self, lines: list[Line]):
+        for line in lines:
+            if isinstance(line, Label):
+                self.define_label(line.name)
+            else:
+                instruction = self.encode(line)
+                self.instructions += instruction
+                self.program_offset += len(instruction)
+        self.resolve()
+
+    def encode(self, line: tuple) -> list[int]:
+        mnemonic, *operands = line
+        kinds = tuple(operand_kind(operand) for operand in operands)
+        name = opcode_name(line)
+        if name is None:
+            raise Exception(f"Error on instruction: {format_line(line)}")
+        instruction = [opcodes[name]]
+        for operand, kind in zip(operands, kinds):
+            if kind == "constant":
+                instruction.append(operand)
+            elif kind == "address":
+                try:
+                    address = int(operand[1:])
+                except ValueError:
+                    raise Exception("Cannot cast address to int")
+                instruction += convert_address_to_bytes(address)
+            elif kind == "label":
+                self.relocations.append((self.program_offset + len(instruction), operand))
+                instruction += [0, 0]
+        return instruction
+
+    # Resolve jump / call names with symbol table
+    # Each relocation is the position of a two-byte placeholder that is
+    # patched in place with the address of its label
+    def resolve(self):
         start_address = self.start_address
         if start_address is None:
             program_size = len(self.instructions)
             start_address = MEMORY_SIZE - program_size
         for label in self.label_offset:
             self.label_offset[label] += start_address
-        for routine in self.imports['routines']:
-            self.label_offset[routine] = self.imports['routines'][routine]['address']
-        for i, instruction in enumerate(self.instructions):
-            if instruction in self.label_offset:
-                prefix = self.instructions[:i]
-                try:
-                    suffix = self.instructions[(i + 2):]
-                except IndexError:
-                    suffix = []
-                address_bytes = convert_address_to_bytes(self.label_offset[instruction])
-                self.instructions = prefix + list(address_bytes) + suffix
-            elif instruction == "<LOW_BYTE>":
-                continue
+        # Only imported routines that are actually called are looked up
+        for position, label in self.relocations:
+            if label in self.imports['routines']:
+                address = self.imports['routines'][label]['address']
+            elif label in self.label_offset:
+                address = self.label_offset[label]
             else:
-                try:
-                    int(instruction)
-                except ValueError:
-                    raise Exception(f"Error on instruction: {instruction}")
+                raise Exception(f"Error on instruction: {label}")
+            address_bytes = convert_address_to_bytes(address)
+            self.instructions[position:position + 2] = address_bytes
         for label in self.label_offset:
             if label in self.exports['routines']:
                 self.exports['routines'][label].update({'address': self.label_offset[label]})
 
     def visitLabel(self, ctx: VtxParser.LabelContext):
-        label_name = ctx.LABEL().getText()
+        self.define_label(ctx.LABEL().getText())
+
+    def define_label(self, label_name: str):
         if label_name in self.label_offset:
             print(f"Warning: Label {label_name} defined more than once")
         self.label_offset[label_name] = self.program_offset
@@ -140,7 +278,7 @@ class Assembler(VtxVisitor):
             except IndexError:
                 raise Exception("Cannot cast address to int")
             high_byte, low_byte = convert_address_to_bytes(address)
-            return [instruction_names.index("ADD@"), high_byte, low_byte]
+            return [instruction_names.index(f"{instruction}@"), high_byte, low_byte]
 
     def visitSub(self, ctx: VtxParser.SubContext):
         source = ctx.source()
@@ -161,7 +299,7 @@ class Assembler(VtxVisitor):
             except IndexError:
                 raise Exception("Cannot cast address to int")
             high_byte, low_byte = convert_address_to_bytes(address)
-            return [instruction_names.index("OR@"), high_byte, low_byte]
+            return [instruction_names.index(f"{instruction}@"), high_byte, low_byte]
 
     def visitBinaryAnd(self, ctx: VtxParser.BinaryAndContext):
         source = ctx.source()
@@ -246,14 +384,16 @@ class Assembler(VtxVisitor):
         if ctx.LABEL():
             label_name = ctx.LABEL().getText()
             instruction = instruction_names.index(f"J{condition}I")
-            return [instruction, label_name, "<LOW_BYTE>"]
+            self.relocations.append((self.program_offset + 1, label_name))
+            return [instruction, 0, 0]
         elif ctx.M():
             return [instruction_names.index(f"J{condition}M")]
 
     def visitCall(self, ctx: VtxParser.CallContext):
         if ctx.LABEL():
             label_name = ctx.LABEL().getText()
-            return [instruction_names.index("CAL"), label_name, "<LOW_BYTE>"]
+            self.relocations.append((self.program_offset + 1, label_name))
+            return [instruction_names.index("CAL"), 0, 0]
         else:
             address = int(ctx.ADDRESS().getText()[1:])
             high_byte, low_byte = convert_address_to_bytes(address)
@@ -0,0 +1,129 @@
+import os
+import json
+import fcntl
+import hashlib
+from typing import Optional
+from instructions import instructions
+from SymbolTable import SymbolTable
+
+DEFAULT_CACHE_DIRECTORY = ".storn_cache"
+DEFAULT_MAX_SIZE = 64 * 2**20
+STATS_FILENAME = "stats.json"
+STATS_LOCK_FILENAME = "stats.lock"
+# Changes to the compiler itself must also invalidate entries
+COMPILER_SOURCES = ["Storn.g4", "CodeGenerator.py", "PeepholeOptimiser.py", "Assembler.py", "FastVtxParser.py", "compile_storn.py", "Runtime.py", "runtime.vtx"]
+
+def hash_isa() -> str:
+    isa = [(instruction.name, instruction.microinstructions, instruction.scopes) for instruction in instructions]
+    return hashlib.sha256(json.dumps(isa).encode()).hexdigest()
+
+def hash_compiler() -> str:
+    digest = hashlib.sha256()
+    directory = os.path.dirname(os.path.abspath(__file__))
+    for filename in COMPILER_SOURCES:
+        with open(os.path.join(directory, filename), "rb") as source_file:
+            digest.update(source_file.read())
+    return digest.hexdigest()
+
+# On-disk cache of compiled modules, content-addressed by everything that
+# determines the compiler's output. Each entry is one JSON file holding the
+# ROM, assembly and exports. Entries are evicted least recently used first
+# once the directory exceeds `max_size` bytes
+class BuildCache:
+    def __init__(self, directory: str = DEFAULT_CACHE_DIRECTORY, max_size: int = DEFAULT_MAX_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, source: str, imports: dict, start_address: Optional[int], is_main: bool, options: Optional[dict] = None) -> str:
+        key = {
+            "source": source,
+            "imports": imports.digest if isinstance(imports, SymbolTable) else imports,
+            "start_address": start_address,
+            "is_main": is_main,
+            "options": options or {},
+            "isa": hash_isa(),
+            "compiler": hash_compiler(),
+        }
+        return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[tuple[bytearray, str, dict]]:
+        path = os.path.join(self.directory, f"{key}.json")
+        try:
+            with open(path, "r") as entry_file:
+                entry = json.load(entry_file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.record("misses")
+            return None
+        try:
+            os.utime(path) # mark as recently used
+        except FileNotFoundError: # evicted by another process since
+            pass
+        self.record("hits")
+        return bytearray.fromhex(entry["program"]), entry["assembly"], entry["exports"]
+
+    def put(self, key: str, program: bytearray, assembly: str, exports: dict):
+        entry = {"program": program.hex(), "assembly": assembly, "exports": exports}
+        self.write(f"{key}.json", json.dumps(entry))
+        self.evict()
+
+    # Each entry's path with its size and last use. Other processes sharing
+    # the directory may evict entries at any point, so those are left out
+    def entries(self) -> list[tuple[str, os.stat_result]]:
+        entries = []
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith(".json") or entry.name == STATS_FILENAME:
+                continue
+            try:
+                entries.append((entry.path, entry.stat()))
+            except FileNotFoundError:
+                continue
+        return entries
+
+    def evict(self):
+        entries = sorted(self.entries(), key=lambda entry: entry[1].st_mtime)
+        size = sum(stat.st_size for _, stat in entries)
+        while entries and size > self.max_size:
+            path, stat = entries.pop(0)
+            size -= stat.st_size
+            try:
+                os.remove(path)
+            except FileNotFoundError: # already evicted by another process
+                continue
+            self.record("evictions")
+
+    def counters(self) -> dict:
+        try:
+            with open(os.path.join(self.directory, STATS_FILENAME), "r") as stats_file:
+                return json.load(stats_file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def stats(self) -> dict:
+        stats = self.counters()
+        entries = self.entries()
+        return {
+            "hits": stats.get("hits", 0),
+            "misses": stats.get("misses", 0),
+            "evictions": stats.get("evictions", 0),
+            "entries": len(entries),
+            "size": sum(stat.st_size for _, stat in entries),
+            "max_size": self.max_size,
+        }
+
+    # Processes sharing the directory take turns updating the counters, so
+    # none of their updates are lost
+    def record(self, counter: str):
+        with open(os.path.join(self.directory, STATS_LOCK_FILENAME), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            counters = self.counters()
+            counters[counter] = counters.get(counter, 0) + 1
+            self.write(STATS_FILENAME, json.dumps(counters))
+
+    # Write then rename so concurrent compiles never read a partial file
+    def write(self, filename: str, contents: str):
+        path = os.path.join(self.directory, filename)
+        temporary_path = f"{path}.{os.getpid()}.tmp"
+        with open(temporary_path, "w") as temporary_file:
+            temporary_file.write(contents)
+        os.replace(temporary_path, path)
@@ -1,12 +1,103 @@
-from typing import Dict, List, Tuple, Literal
+from typing import Dict, List, Optional, Set, Tuple, Literal, Union
 from storn.StornVisitor import StornVisitor
 from storn.StornParser import StornParser
+from antlr4.tree.Tree import TerminalNode
+from Assembler import Label, Line, line_size
+from PeepholeOptimiser import NEGATED_CONDITIONS, effects
+import Runtime
 import copy
 
 GLOBAL_VAR_BASE = 0
-GLOBAL_VAR_BASE_LOW = GLOBAL_VAR_BASE & 0b11111111
-GLOBAL_VAR_BASE_HIGH = GLOBAL_VAR_BASE >> 8
 STATUS_REGISTERS = ["s", "a", "b", "c", "h", "l"]
+# Registers expression results are kept in, in order of preference. HL is
+# last since it holds lvalue addresses
+EXPRESSION_REGISTERS = ["b", "c", "l", "h"]
+# Routines with few enough small parameters take their arguments in BC then
+# HL and return their result in BC, as the runtime routines do. 8 bit values
+# use the low register of the pair
+ARGUMENT_REGISTERS = [("b", "c"), ("h", "l")]
+RESULT_REGISTERS = ("b", "c")
+# Copies of up to this many bytes are unrolled rather than looped
+DEFAULT_UNROLL_LIMIT = 8
+# Routines compiled to up to this many bytes are inlined at their calls
+DEFAULT_INLINE_LIMIT = 96
+# HL := HL +/- 1
+INCREMENT_HL = [("ldr", "a", "l"), ("inc",), ("ldr", "l", "a"), ("ldr", "a", "h"), ("inc", "cc"), ("ldr", "h", "a")]
+DECREMENT_HL = [("ldr", "a", "l"), ("dec",), ("ldr", "l", "a"), ("ldr", "a", "h"), ("dec", "cc"), ("ldr", "h", "a")]
+
+# Whether a comparison holds for constant operands, as the ALU would decide
+# it: the sign is the top bit of the difference
+def compare(width: int, flag: str, minuend: int, subtrahend: int) -> bool:
+    difference = (minuend - subtrahend) & ((1 << width) - 1)
+    if flag == "zf":
+        return difference == 0
+    return (difference >> (width - 1) == 1) == (flag == "sf")
+
+# The expression inside a bitwise expression that's only parenthesised
+def parenthesised(ctx: StornParser.BitwiseExprContext) -> Optional[StornParser.ExpressionContext]:
+    node = ctx
+    while node.getChildCount() == 1:
+        node = node.getChild(0)
+    if isinstance(node, StornParser.PrimaryExprContext):
+        return node.expression()
+    return None
+
+# The call an expression consists of, if that's all it is
+def only_call(ctx: StornParser.ExpressionContext) -> Optional[StornParser.CallContext]:
+    node = ctx
+    while node.getChildCount() == 1:
+        node = node.getChild(0)
+    return node if isinstance(node, StornParser.CallContext) else None
+
+# SP := SP + delta. A byte or two is quicker to push or pop than to add,
+# and nothing is needed for none
+def adjust_sp(delta: int) -> List[Line]:
+    if delta == 0:
+        return []
+    if abs(delta) <= 2:
+        return [("psh", "a") if delta < 0 else ("pop", "a")] * abs(delta)
+    operation = "add" if delta > 0 else "sub"
+    size = abs(delta)
+    return [
+        ("ldr", "a", "spl"),
+        (operation, size & 0b11111111),
+        ("ldr", "spl", "a"),
+        ("ldr", "a", "sph"),
+        (operation, "cc", size >> 8),
+        ("ldr", "sph", "a"),
+    ]
+
+# Whether a routine is called with its arguments and result in registers:
+# up to two [8] or [16] parameters and a [0], [8] or [16] result
+def passes_in_registers(parameters: Dict[str, "Type"], return_type: "Type") -> bool:
+    return (len(parameters) <= len(ARGUMENT_REGISTERS)
+        and all(isinstance(parameter, BaseType) and parameter.width in (8, 16) for parameter in parameters.values())
+        and isinstance(return_type, BaseType) and return_type.width in (0, 8, 16))
+
+# The status registers the given lines write, in the order they're saved
+def written_registers(lines: List[Line]) -> List[str]:
+    written = set()
+    for line in lines:
+        if not isinstance(line, Label):
+            written |= effects(line)[1]
+    if written & {"z", "carry"}:
+        written.add("s")
+    return [register for register in STATUS_REGISTERS if register in written]
+
+# Every node of the given kind in a parse tree
+def descendants(ctx, kind: type) -> list:
+    nodes = [node for i in range(ctx.getChildCount()) for node in descendants(ctx.getChild(i), kind)]
+    return [ctx] + nodes if isinstance(ctx, kind) else nodes
+
+# Every name in a parse tree
+def names_in(ctx) -> List[str]:
+    if isinstance(ctx, TerminalNode):
+        return [ctx.getText()] if ctx.getSymbol().type == StornParser.NAME else []
+    return [name for i in range(ctx.getChildCount()) for name in names_in(ctx.getChild(i))]
+
+# Operand for an absolute address, eg. `ldr a @1024`
+def absolute(address: int) -> str:
+    return f"@{address & 0xFFFF}"
 
 class CompileError(Exception):
     def __init__(self, message, line=None, column=None):
@@ -188,10 +279,53 @@ class Routine:
         self.return_type = return_type
         self.scope = scope
         self.is_entry = is_entry
+        # What the routine's code uses, for dead code elimination. `span` is
+        # the range of its instructions, and None for imported routines
+        self.span: Optional[Tuple[int, int]] = None
+        self.callees: Set[str] = set()
+        self.global_references: Set[str] = set()
+        self.runtime_routines: Set[str] = set()
+        # The routine's parse tree and compiled size, for inlining
+        self.ctx: Optional[StornParser.RoutineContext] = None
+        self.size = 0
+        # A routine without parameters, locals or a return value on the stack
+        # doesn't need BP, so it isn't saved or set. One whose frame is empty returns with
+        # SP already at BP, since statements leave the stack as they found it
+        self.frameless = False
+        self.empty_frame = False
+        # Whether its arguments and result are passed in registers rather
+        # than on the stack (see ARGUMENT_REGISTERS)
+        self.registers = False
+        # The status registers a call to it may change, including through
+        # the routines it calls
+        self.clobbers: List[str] = list(STATUS_REGISTERS)
+        # The label a return jumps to and the frame offset of the return
+        # value when the routine's body is inlined, and parameters replaced
+        # by constant arguments
+        self.inline: Optional[Tuple[str, int]] = None
+        self.constants: Dict[str, Tuple[Type, int]] = {}
+
+# An expression result, either held in registers (most significant byte
+# first), known at compile time or on the stack. `position` is the index of
+# the instruction after the one completing a result held in registers.
+# Addresses may also be held in BP and carry an `offset` still to be added
+class Operand:
+    def __init__(self, size: int, registers: Optional[Tuple[str, ...]] = None, constant: Optional[int] = None, position: int = 0, offset: int = 0):
+        self.size = size
+        self.registers = registers
+        self.constant = constant
+        self.position = position
+        self.offset = offset
+
+    # Registers or constant bytes, most significant first
+    def bytes(self) -> List[Union[str, int]]:
+        if self.constant is not None:
+            return [(self.constant >> (8 * i)) & 0b11111111 for i in reversed(range(self.size))]
+        return list(self.registers)
 
 class CodeGenerator(StornVisitor):
-    def __init__(self, imports, exports, is_main: bool):
-        self.instructions: List[str] = ["jmp entry"]
+    def __init__(self, imports, exports, is_main: bool, unroll_limit: int = DEFAULT_UNROLL_LIMIT, inline_limit: int = DEFAULT_INLINE_LIMIT):
+        self.instructions: List[Line] = [("jmp", "entry")]
         self.data_table: Dict[str, DataType] = {}
         self.globals: Dict[str, Type] = {}
         self.global_offset = 0
@@ -199,9 +333,21 @@ class CodeGenerator(StornVisitor):
         self.current_routine: Routine = Routine({}, Type(), {}, False)
         self.label_count = 0
         self.loop_label_stack = []
+        self.operands: List[Operand] = []
+        # Indices into the instructions still to be used, moved along as
+        # spills insert pushes before them
+        self.marks: List[int] = []
         self.imports = imports
         self.exports = exports
         self.is_main = is_main
+        self.unroll_limit = unroll_limit
+        self.inline_limit = inline_limit
+        # Bytes below BP the current routine's locals and the bodies inlined
+        # into it use, now and at most
+        self.frame_size = 0
+        self.frame_peak = 0
+        # Runtime library routines the module calls, linked after its own code
+        self.runtime_routines: Set[str] = set()
 
     def visitImportStmt(self, ctx: StornParser.ImportStmtContext):
         name = ctx.NAME().getText()
@@ -231,9 +377,12 @@ class CodeGenerator(StornVisitor):
                 parameter_type = Type.import_(parameters_dict[parameter]['type_'])
                 parameter_type.calculate_size(self.data_table)
                 parameters[parameter] = parameter_type
-            return_type_dict = routine['return_type']
+            return_type_dict = routine['return_type']['type_']
             return_type = Type.import_(return_type_dict)
-            self.routine_table[name] = (Routine(parameters, return_type, {}, False))
+            imported = Routine(parameters, return_type, {}, False)
+            imported.registers = routine.get('registers', False)
+            imported.clobbers = routine.get('clobbers', list(STATUS_REGISTERS))
+            self.routine_table[name] = imported
         else:
             raise Exception("Unknown import type")
 
@@ -287,35 +436,115 @@ class CodeGenerator(StornVisitor):
         if name in self.routine_table:
             raise CompileError("Redeclaring routine", ctx.NAME().start.line, ctx.NAME().start.column)
         routine = Routine(parameters, return_type, routine_scope, name == "entry")
+        routine.ctx = ctx
+        routine.registers = name != "entry" and passes_in_registers(parameters, return_type)
+        # Parameters passed in registers are pushed by the routine itself, so
+        # they're the first values in its frame, below BP like locals
+        pushed = 0
+        if routine.registers:
+            for parameter in parameters.values():
+                pushed += parameter.size
+                parameter.calculate_offset(-pushed)
+            for local in routine_scope.values():
+                local.calculate_offset(local.offset + pushed)
+            size += pushed
+        # The routines it calls are already compiled, other than itself, so
+        # whether any are inlined into its frame is already known
+        calls = [call.NAME().getText() for call in descendants(ctx.statements(), StornParser.CallContext)]
+        inlines = any(self.inlinable(callee, self.routine_table[callee]) for callee in calls if callee in self.routine_table)
+        routine.empty_frame = size == 0 and not inlines
+        routine.frameless = routine.empty_frame and not parameters and (return_type.size == 0 or routine.registers)
         self.routine_table[name] = routine
         self.current_routine = routine
         if name != "entry":
             self.exports['routines'].update({
                 name: {
                     'parameters': {parameter: {'type_': parameters[parameter].export} for parameter in parameters},
-                    'return_type': {'type_': return_type.export}
+                    'return_type': {'type_': return_type.export},
+                    'registers': routine.registers,
                 }
             })
 
-        # Prologue
-        size_low = size & 0b11111111
-        size_high = size >> 8
+        # Prologue. The frame is allocated once the body is compiled, since
+        # the bodies inlined into it may need more room than its locals
+        start = len(self.instructions)
         self.instructions += [
-            f"{name}:",
-            *([f"psh {register}" for register in STATUS_REGISTERS] if name == "entry" and not self.is_main else []),
-            "psh bph",
-            "psh bpl",
-            "ldr bph sph",
-            "ldr bpl spl",
-            "ldr a spl",
-            f"sub {size_low}",
-            "ldr spl a",
-            "ldr a sph",
-            f"sub cc {size_high}",
-            "ldr sph a",
+            Label(name),
+            *([
+                ("psh", "bph"),
+                ("psh", "bpl"),
+                ("ldr", "bph", "sph"),
+                ("ldr", "bpl", "spl"),
+            ] if not routine.frameless else []),
         ]
+        if routine.registers:
+            for parameter, registers in zip(parameters.values(), ARGUMENT_REGISTERS):
+                self.instructions += [("psh", register) for register in registers[-parameter.size:]]
+        frame_index = len(self.instructions)
+        self.frame_size = self.frame_peak = size
 
         self.visitStatements(ctx.statements())
+        self.instructions[frame_index:frame_index] = adjust_sp(pushed - self.frame_peak)
+        routine.clobbers = self.written_by(routine, name, start)
+        if name != "entry":
+            self.exports['routines'][name]['clobbers'] = routine.clobbers
+        # An interrupt handler saves the registers it changes, and restores
+        # them before each return
+        if name == "entry" and not self.is_main:
+            self.instructions[start + 1:start + 1] = [("psh", register) for register in routine.clobbers]
+            for i in reversed(range(start, len(self.instructions))):
+                if self.instructions[i] == ("irt",):
+                    self.instructions[i:i] = [("pop", register) for register in reversed(routine.clobbers)]
+        routine.span = (start, len(self.instructions))
+        routine.size = sum(line_size(line) for line in self.instructions[start:])
+
+    # The status registers written by a routine's code from `start` on, by the
+    # routines it calls and by the runtime routines it uses
+    def written_by(self, routine: Routine, name: str, start: int) -> List[str]:
+        lines = self.instructions[start:]
+        runtime_lines = Runtime.load()
+        for runtime_routine in routine.runtime_routines:
+            lines += runtime_lines[runtime_routine]
+        clobbered = set(written_registers(lines))
+        for callee in routine.callees - {name}:
+            clobbered.update(self.routine_table[callee].clobbers)
+        return [register for register in STATUS_REGISTERS if register in clobbered]
+
+    # Drops routines that can't be reached through calls from `entry` (the
+    # interrupt handler in modules other than main) or from a routine in
+    # `keep`, which other modules import. Exported globals that no remaining
+    # routine references and that aren't kept are no longer exported, though
+    # their offsets stay as they are since they're already part of addresses.
+    # Returns the removed routines' instructions and the removed globals
+    def eliminate_dead_code(self, keep: Set[str]) -> Tuple[Dict[str, List[Line]], Dict[str, Type]]:
+        defined = {name: routine for name, routine in self.routine_table.items() if routine.span is not None}
+        reachable = set()
+        pending = [name for name in defined if name == "entry" or name in keep]
+        while pending:
+            name = pending.pop()
+            if name in reachable:
+                continue
+            reachable.add(name)
+            pending += [callee for callee in defined[name].callees if callee in defined]
+
+        removed_routines = {}
+        for name, routine in sorted(defined.items(), key=lambda item: item[1].span[0], reverse=True):
+            if name in reachable:
+                continue
+            start, end = routine.span
+            removed_routines[name] = self.instructions[start:end]
+            del self.instructions[start:end]
+            del self.routine_table[name]
+            self.exports['routines'].pop(name, None)
+        self.runtime_routines = set().union(*(defined[name].runtime_routines for name in reachable))
+
+        referenced = set().union(*(defined[name].global_references for name in reachable))
+        removed_globals = {}
+        for name in list(self.exports['globals']):
+            if name not in referenced and name not in keep:
+                removed_globals[name] = self.globals[name]
+                del self.exports['globals'][name]
+        return dict(reversed(removed_routines.items())), removed_globals
 
     def visitTypedParamList(self, ctx: StornParser.TypedParamListContext) -> Dict[str, Type]:
         parameters: Dict[str, Type] = {}
@@ -382,6 +611,14 @@ class CodeGenerator(StornVisitor):
         for statement in statements:
             self.visit(statement)
 
+    def visitStatement(self, ctx: StornParser.StatementContext):
+        self.visitChildren(ctx)
+        # A call's result is unused, and popped if it's on the stack
+        if ctx.call():
+            result = self.operands.pop()
+            if result.registers is None and result.constant is None:
+                self.instructions += adjust_sp(result.size)
+
     def visitSetStmt(self, ctx: StornParser.SetStmtContext):
         lvalue = ctx.lvalue()
         expression = ctx.expression()
@@ -393,28 +630,85 @@ class CodeGenerator(StornVisitor):
         if lvalue_type != expression_type:
             raise CompileError(f"lvalue and expression are of different types, namely, {lvalue_type} and {expression_type}, respectively", lvalue.start.line, lvalue.start.column)
 
-        # Pop bytes from stack to memory range [HL, HL + (size - 1)]
-        # The top of the stack is the lowest byte of the variable, hence
-        # we pop into HL, pop into HL + 1, pop into HL + 2, etc.
-        self.instructions += [
-            f"ldr c {expression_type.size}",
-            f"L{self.label_count}:",
-            "ldr a c",
-            f"jmp zf L{self.label_count + 1}",
-            "dec",
-            "ldr c a",
-            "pop a",
-            "str m a",
-            "ldr a l",
-            "inc",
-            "ldr l a",
-            "ldr a h",
-            "inc cc",
-            "ldr h a",
-            f"jmp L{self.label_count}",
-            f"L{self.label_count + 1}:",
-        ]
-        self.label_count += 2
+        self.store_operand()
+
+    # Pops an address then stores the operand under it to memory range
+    # [address, address + (size - 1)], lowest byte first
+    def store_operand(self):
+        address = self.pop_operand()
+        if address.constant is not None and self.operands[-1].size <= max(self.unroll_limit, 2):
+            size = self.operands[-1].size
+            if size > 2:
+                self.pop_operand()
+                for i in range(size):
+                    self.instructions += [
+                        ("pop", "a"),
+                        ("str", absolute(address.constant + i), "a"),
+                    ]
+                return
+            value = self.pop_value()
+            for i, byte in enumerate(reversed(value.bytes())):
+                if isinstance(byte, int):
+                    self.instructions += [
+                        ("ldr", "a", byte),
+                        ("str", absolute(address.constant + i), "a"),
+                    ]
+                else:
+                    self.instructions += [
+                        ("str", absolute(address.constant + i), byte),
+                    ]
+            return
+
+        self.address_in_hl(address)
+        if 2 < self.operands[-1].size <= self.unroll_limit:
+            size = self.pop_operand().size
+            for i in range(size):
+                self.instructions += [
+                    *(INCREMENT_HL if i > 0 else []),
+                    ("pop", "a"),
+                    ("str", "m", "a"),
+                ]
+            return
+        if self.operands[-1].size > 2:
+            size = self.pop_operand().size
+
+            # Pop bytes from stack to memory range [HL, HL + (size - 1)]
+            # The top of the stack is the lowest byte of the variable, hence
+            # we pop into HL, pop into HL + 1, pop into HL + 2, etc.
+            self.instructions += [
+                ("ldr", "c", size),
+                Label(f"L{self.label_count}"),
+                ("ldr", "a", "c"),
+                ("jmp", "zf", f"L{self.label_count + 1}"),
+                ("dec",),
+                ("ldr", "c", "a"),
+                ("pop", "a"),
+                ("str", "m", "a"),
+                ("ldr", "a", "l"),
+                ("inc",),
+                ("ldr", "l", "a"),
+                ("ldr", "a", "h"),
+                ("inc", "cc"),
+                ("ldr", "h", "a"),
+                ("jmp", f"L{self.label_count}"),
+                Label(f"L{self.label_count + 1}"),
+            ]
+            self.label_count += 2
+            return
+
+        value = self.pop_value(avoid=("h", "l"))
+        for i, byte in enumerate(reversed(value.bytes())):
+            if i > 0:
+                self.instructions += INCREMENT_HL
+            if isinstance(byte, int):
+                self.instructions += [
+                    ("ldr", "a", byte),
+                    ("str", "m", "a"),
+                ]
+            else:
+                self.instructions += [
+                    ("str", "m", byte),
+                ]
 
     def visitLvalue(self, ctx: StornParser.LvalueContext) -> Type:
         return self.visitIndexLvalue(ctx.indexLvalue())
@@ -428,39 +722,58 @@ class CodeGenerator(StornVisitor):
             if not isinstance(lvalue, ArrayType):
                 raise CompileError("Attempting to index non array type", ctx.projectionLvalue().start.line, ctx.projectionLvalue().start.line)
 
-            # HL is modified by expression calculation
-            self.instructions += [
-                "psh l",
-                "psh h",
-            ]
+            # The address stays on the operand stack while the index is
+            # computed, so if it's in HL it's only saved if the index
+            # expression overwrites it
             index = self.visitExpression(ctx.expression(i))
             if not (isinstance(index, BaseType) and index.width == 8):
                 raise CompileError("Attempting to index by expression that doesn't evaluate to [8]", ctx.expression(i).start.line, ctx.expression(i).start.column)
 
             size = lvalue.type_.size
 
-            # Naive multiplication
-            # HL := HL + index * size
-            self.instructions += [
-                "pop b", # index
-                "pop h", # saved state
-                "pop l", # saved state
-                f"ldr c {size}",
-                f"L{self.label_count}:",
-                "ldr a c",
-                f"jmp zf L{self.label_count + 1}",
-                "dec",
-                "ldr c a",
-                "ldr a l",
-                "add b",
-                "ldr l a",
-                "ldr a h",
-                "dec cc",
-                "ldr h a",
-                f"jmp L{self.label_count}",
-                f"L{self.label_count + 1}:",
-            ]
-            self.label_count += 2
+            index_value = self.pop_value(avoid=("h", "l"))
+            index_byte, = index_value.bytes()
+            if index_byte in ("h", "l"):
+                register, = self.allocate(1, avoid=("h", "l"))
+                self.instructions += [
+                    ("ldr", register, index_byte),
+                ]
+                index_byte = register
+
+            if isinstance(index_byte, int):
+                self.offset_address(index_byte * size)
+            else:
+                self.address_in_hl(self.pop_operand())
+
+                # Shift and add
+                # HL := HL + index * size, adding index << k for each bit k of size
+                # with the shifted index in (high, index_byte)
+                high = 0 # until the first shift
+                bits = min(size.bit_length(), 16)
+                for bit in range(bits):
+                    if size >> bit & 1:
+                        self.instructions += [
+                            ("ldr", "a", "l"),
+                            ("add", index_byte),
+                            ("ldr", "l", "a"),
+                            ("ldr", "a", "h"),
+                            ("add", "cc", high),
+                            ("ldr", "h", "a"),
+                        ]
+                    if bit == bits - 1:
+                        break
+                    high_source = high
+                    if high_source == 0:
+                        high, = self.allocate(1, avoid=("h", "l", index_byte))
+                    self.instructions += [
+                        ("ldr", "a", index_byte),
+                        ("shl",),
+                        ("ldr", index_byte, "a"),
+                        ("ldr", "a", high_source),
+                        ("shl", "cc"),
+                        ("ldr", high, "a"),
+                    ]
+                self.result_in("h", "l")
 
             lvalue = lvalue.type_
 
@@ -475,7 +788,8 @@ class CodeGenerator(StornVisitor):
         field_count = (ctx.getChildCount() - 1) // 2
         for i in range(field_count):
             if not isinstance(lvalue, DataType):
-                raise CompileError("Attempting to project non data type", ctx.referenceLvalue().start.line, ctx.referenceLvalue().start.column)
+                # `x / y` is a projection, so dividing by a variable needs `x / (y)`
+                raise CompileError("Attempting to project non data type (parenthesise a variable divisor)", ctx.referenceLvalue().start.line, ctx.referenceLvalue().start.column)
 
             field_name = ctx.NAME(i).getText()
 
@@ -488,20 +802,8 @@ class CodeGenerator(StornVisitor):
                 resolved_type = self.data_table[field_type.name].copy()
                 field_type = resolved_type
 
-            offset = field_type.offset
-            offset_low = offset & 0b11111111
-            offset_high = offset >> 8
-
-            # Compute address of field by its offset from parent address in HL
-            # HL := HL + offset
-            self.instructions += [
-                "ldr a l",
-                f"add {offset_low}",
-                "ldr l a",
-                "ldr a h",
-                f"add cc {offset_high}",
-                "ldr h a",
-            ]
+            # Address of field is its offset from parent address
+            self.offset_address(field_type.offset)
 
             lvalue = field_type
 
@@ -514,22 +816,32 @@ class CodeGenerator(StornVisitor):
             if not isinstance(lvalue, ReferenceType):
                 raise CompileError("Attempting to dereference non reference type", ctx.primaryLvalue().start.line, ctx.primaryLvalue().start.column)
 
-            # Address of reference is in HL; reference is a 2-byte little endian memory address
+            # Reference is a 2-byte little endian memory address
             # Need address of object referenced by said reference in HL
-            # Hence, store ram[HL] in HL
+            # Hence, store ram[address] in HL
             # i.e.:
-            # L := ram[HL]
-            # H := ram[HL + 1]
-            self.instructions += [
-                "ldr b m", # L
-                "ldr a l",
-                "inc",
-                "ldr l a",
-                "ldr a h",
-                "inc cc",
-                "ldr h m",
-                "ldr l b",
-            ]
+            # L := ram[address]
+            # H := ram[address + 1]
+            address = self.pop_operand()
+            if address.constant is not None:
+                self.instructions += [
+                    ("ldr", "l", absolute(address.constant)),
+                    ("ldr", "h", absolute(address.constant + 1)),
+                ]
+            else:
+                self.address_in_hl(address)
+                temporary, = self.allocate(1, avoid=("h", "l"))
+                self.instructions += [
+                    ("ldr", temporary, "m"), # L
+                    ("ldr", "a", "l"),
+                    ("inc",),
+                    ("ldr", "l", "a"),
+                    ("ldr", "a", "h"),
+                    ("inc", "cc"),
+                    ("ldr", "h", "m"),
+                    ("ldr", "l", temporary),
+                ]
+            self.result_in("h", "l")
 
             unresolved_type = lvalue.type_
             if isinstance(unresolved_type, UnresolvedType):
@@ -546,15 +858,18 @@ class CodeGenerator(StornVisitor):
             return self.visitLvalue(ctx.lvalue())
 
         # Whether to add or subtract from BP to get variable address
-        offset_operation = "add"
+        sign = 1
+        is_global = False
         variable_name = ctx.NAME().getText()
         if variable_name in self.current_routine.scope:
             variable = self.current_routine.scope[variable_name]
-            offset_operation = "sub"
+            sign = -1
         elif variable_name in self.current_routine.parameters:
             variable = self.current_routine.parameters[variable_name]
         elif variable_name in self.globals:
             variable = self.globals[variable_name]
+            is_global = True
+            self.current_routine.global_references.add(variable_name)
         else:
             raise CompileError("Reference to unknown variable", ctx.NAME().start.line, ctx.NAME().start.column)
 
@@ -564,92 +879,71 @@ class CodeGenerator(StornVisitor):
             variable = resolved_variable
 
         offset = variable.offset
-        offset_low = offset & 0b11111111
-        offset_high = offset >> 8
 
-        if variable_name in self.globals:
-            base_low = GLOBAL_VAR_BASE_LOW
-            base_high = GLOBAL_VAR_BASE_HIGH
-        else:
-            base_low = "bpl"
-            base_high = "bph"
+        # Globals are at a fixed address
+        if is_global:
+            self.result_constant(2, (GLOBAL_VAR_BASE + offset) & 0xFFFF)
+            return variable
 
-        # Compute address of variable by its offset from BP
-        # HL := BP +/- offset
-        self.instructions += [
-            f"ldr a {base_low}",
-            f"{offset_operation} {offset_low}",
-            "ldr l a",
-            f"ldr a {base_high}",
-            f"{offset_operation} cc {offset_high}",
-            "ldr h a",
-        ]
+        # Address of variable is its offset from BP
+        self.result_frame_address(sign * offset)
 
         return variable
 
     def visitIfStmt(self, ctx: StornParser.IfStmtContext):
-        expression = self.visitExpression(ctx.expression())
-        if not isinstance(expression, BaseType):
-            raise CompileError("If condition expression evaluates to non numeric type", ctx.expression().start.line, ctx.expression().start.column)
-
         fail_label = self.label_count
         final_label = self.label_count + 1
         self.label_count += 2
 
-        if expression.width == 8:
-            self.instructions += [
-                "pop a",
-                f"jmp zf L{fail_label}"
-            ]
-        elif expression.width == 16:
-            self.instructions += [
-                "pop b",
-                "pop a",
-                "or b",
-                f"jmp zf L{fail_label}"
-            ]
+        expression = self.condition(ctx.expression(), f"L{fail_label}")
+        if not isinstance(expression, BaseType):
+            raise CompileError("If condition expression evaluates to non numeric type", ctx.expression().start.line, ctx.expression().start.column)
 
         self.visitStatements(ctx.statements())
         self.instructions += [
-            f"jmp L{final_label}",
-            f"L{fail_label}:",
+            ("jmp", f"L{final_label}"),
+            Label(f"L{fail_label}"),
         ]
 
         if ctx.elifStmt():
             for elif_stmt in ctx.elifStmt():
-                expression = self.visitExpression(elif_stmt.expression())
-                if not isinstance(expression, BaseType):
-                    raise CompileError("Elif condition expression evaluates to non numeric type", elif_stmt.expression().start.line, elif_stmt.expression().start.column)
-
                 fail_label = self.label_count
                 self.label_count += 1
 
-                if expression.width == 8:
-                    self.instructions += [
-                        "pop a",
-                        f"jmp zf L{fail_label}"
-                    ]
-                elif expression.width == 16:
-                    self.instructions += [
-                        "pop b",
-                        "pop a",
-                        "or b",
-                        f"jmp zf L{fail_label}"
-                    ]
+                expression = self.condition(elif_stmt.expression(), f"L{fail_label}")
+                if not isinstance(expression, BaseType):
+                    raise CompileError("Elif condition expression evaluates to non numeric type", elif_stmt.expression().start.line, elif_stmt.expression().start.column)
 
                 self.visitStatements(elif_stmt.statements())
                 self.instructions += [
-                    f"jmp L{final_label}",
-                    f"L{fail_label}:",
+                    ("jmp", f"L{final_label}"),
+                    Label(f"L{fail_label}"),
                 ]
 
         if ctx.elseStmt():
             self.visitStatements(ctx.elseStmt().statements())
 
         self.instructions += [
-            f"L{final_label}:",
+            Label(f"L{final_label}"),
         ]
 
+    # Evaluates a condition, jumping to `label` if it's false. Comparisons and
+    # chains of `and`/`or` branch directly rather than producing a boolean
+    def condition(self, ctx: StornParser.ExpressionContext, label: str) -> Type:
+        logical_ctx = ctx.logicalExpr()
+        true_label = f"L{self.label_count}"
+        self.label_count += 1
+        expression, constant = self.logical_branches(logical_ctx, true_label, label, as_value=False)
+        if constant is False:
+            self.instructions += [
+                ("jmp", label),
+            ]
+        if logical_ctx.logicalOp():
+            self.instructions += [
+                Label(true_label),
+            ]
+        return expression
+
     def visitLoopStmt(self, ctx: StornParser.LoopStmtContext):
         start_label = self.label_count
         end_label = self.label_count + 1
@@ -657,14 +951,14 @@ class CodeGenerator(StornVisitor):
         self.label_count += 2
 
         self.instructions += [
-            f"L{start_label}:",
+            Label(f"L{start_label}"),
         ]
 
         self.visitStatements(ctx.statements())
 
         self.instructions += [
-            f"jmp L{start_label}",
-            f"L{end_label}:",
+            ("jmp", f"L{start_label}"),
+            Label(f"L{end_label}"),
         ]
 
         self.loop_label_stack.pop()
@@ -673,13 +967,13 @@ class CodeGenerator(StornVisitor):
         # Start label is on top of loop label stack
         # End label is start label + 1
         self.instructions += [
-            f"jmp L{self.loop_label_stack[-1] + 1}"
+            ("jmp", f"L{self.loop_label_stack[-1] + 1}")
         ]
 
     def visitContinueStmt(self, ctx: StornParser.ContinueStmtContext):
         # See visitBreakStmt
         self.instructions += [
-            f"jmp L{self.loop_label_stack[-1]}"
+            ("jmp", f"L{self.loop_label_stack[-1]}")
         ]
 
     def visitCall(self, ctx: StornParser.CallContext) -> Type:
@@ -688,20 +982,21 @@ class CodeGenerator(StornVisitor):
             routine = self.routine_table[routine_name]
         else:
             raise CompileError("Reference to unknown routine", ctx.NAME().start.line, ctx.NAME().start.column)
+        if self.inlinable(routine_name, routine):
+            return self.inline_call(ctx, routine)
+        self.current_routine.callees.add(routine_name)
+        if routine.registers:
+            self.arguments_in_registers(ctx, routine)
+            self.instructions += [
+                ("cal", routine_name),
+            ]
+            self.result_in_registers(routine.return_type)
+            return routine.return_type
 
         # Allocate space for return bytes on stack
         return_type = routine.return_type
         return_size = return_type.size
-        return_size_low = return_size & 0b11111111
-        return_size_high = return_size >> 8
-        self.instructions += [
-            "ldr a spl",
-            f"sub {return_size_low}",
-            "ldr spl a",
-            "ldr a sph",
-            f"sub cc {return_size_high}",
-            "ldr sph a",
-        ]
+        self.instructions += adjust_sp(-return_size)
 
         parameters = ctx.parameters().expression()
         expected_parameter_types = self.routine_table[routine_name].parameters.values()
@@ -711,195 +1006,632 @@ class CodeGenerator(StornVisitor):
             parameter_type = self.visitExpression(parameter)
             if parameter_type != expected_parameter_type:
                 raise CompileError("Parameter expression is an inconsistent type with routine expectation", parameter.start.line, parameter.start.column)
+            self.push_operand()
             total_parameter_size += parameter_type.size
 
         self.instructions += [
-            f"cal {routine_name}",
+            ("cal", routine_name),
         ]
 
         # Pop parameters
-        param_size_low = total_parameter_size & 0b11111111
-        param_size_high = total_parameter_size >> 8
-        self.instructions +=  [
-            "ldr a spl",
-            f"add {param_size_low}",
-            "ldr spl a",
-            "ldr a sph",
-            f"add cc {param_size_high}",
-            "ldr sph a",
-        ]
+        self.instructions += adjust_sp(total_parameter_size)
+        self.result_on_stack(return_size)
 
         return return_type
 
+    # Evaluates a call's arguments, last first as when they're pushed, then
+    # moves them into the registers the routine takes them in
+    def arguments_in_registers(self, ctx: StornParser.CallContext, routine: Routine):
+        arguments = list(zip(ctx.parameters().expression(), routine.parameters.values()))
+        for argument, expected_parameter_type in reversed(arguments):
+            argument_type = self.visitExpression(argument)
+            if argument_type != expected_parameter_type:
+                raise CompileError("Parameter expression is an inconsistent type with routine expectation", argument.start.line, argument.start.column)
+        values = []
+        for _ in arguments:
+            values.append(self.pop_value(avoid=tuple(register for value in values for register in value.registers or ())))
+        self.move([(value, registers[-value.size:]) for value, registers in zip(values, ARGUMENT_REGISTERS)])
+
+    def result_in_registers(self, type_: Type):
+        if type_.size == 0:
+            self.result_on_stack(0)
+        else:
+            self.result_in(*RESULT_REGISTERS[-type_.size:])
+
+    # Routines are only inlined once compiled, and only if they don't call
+    # themselves. They can only call routines declared before them, so that's
+    # enough to rule out recursion
+    def inlinable(self, name: str, routine: Routine) -> bool:
+        return routine.span is not None and name not in routine.callees and not routine.is_entry and routine.size <= self.inline_limit
+
+    # Compiles `return !f(...)` by reusing the routine's frame: the arguments
+    # replace its own parameters, the frame is popped as on return and f is
+    # jumped to rather than called, so it returns straight to the caller.
+    # f must take as many bytes of parameters and return the same type, so
+    # the caller has made room for them and pops them. Between routines
+    # passing values in registers, only the return types must match. Returns
+    # whether the call could be compiled this way
+    def tail_call(self, ctx: StornParser.CallContext) -> bool:
+        routine_name = ctx.NAME().getText()
+        routine = self.routine_table.get(routine_name)
+        if routine is None or self.inlinable(routine_name, routine):
+            return False
+        if routine.registers or self.current_routine.registers:
+            if not (routine.registers and self.current_routine.registers and routine.return_type == self.current_routine.return_type):
+                return False
+            self.current_routine.callees.add(routine_name)
+            self.arguments_in_registers(ctx, routine)
+            self.instructions += self.leave_frame() + [("jmp", routine_name)]
+            return True
+        arguments = ctx.parameters().expression()
+        parameter_size = sum(parameter.size for parameter in self.current_routine.parameters.values())
+        if (routine.return_type != self.current_routine.return_type
+            or len(arguments) != len(routine.parameters)
+            or sum(parameter.size for parameter in routine.parameters.values()) != parameter_size):
+            return False
+        self.current_routine.callees.add(routine_name)
+
+        # Every argument is evaluated before any parameter is overwritten,
+        # leaving the first on top of the operand stack
+        parameters = list(routine.parameters.values())
+        for argument, expected_parameter_type in zip(reversed(arguments), reversed(parameters)):
+            argument_type = self.visitExpression(argument)
+            if argument_type != expected_parameter_type:
+                raise CompileError("Parameter expression is an inconsistent type with routine expectation", argument.start.line, argument.start.column)
+        offset = 4
+        for parameter in parameters:
+            self.result_frame_address(offset)
+            self.store_operand()
+            offset += parameter.size
+
+        self.instructions += self.leave_frame() + [("jmp", routine_name)]
+        return True
+
+    # Restores the caller's SP and BP, as far as the current routine changed them
+    def leave_frame(self) -> List[Line]:
+        routine = self.current_routine
+        if routine.frameless:
+            return []
+        return [
+            *([("ldr", "sph", "bph"), ("ldr", "spl", "bpl")] if not routine.empty_frame else []),
+            ("pop", "bpl"),
+            ("pop", "bph"),
+        ]
+
+    # Compiles a routine's body in place of a call to it, saving the call,
+    # the prologue and the epilogue. Its parameters, locals and return value
+    # are given slots in the caller's frame below those in use, and returns
+    # jump to the end of the body. A body whose only return is its last
+    # statement leaves the returned value as the call's result directly
+    def inline_call(self, ctx: StornParser.CallContext, routine: Routine) -> Type:
+        routine_ctx = routine.ctx
+        statements = routine_ctx.statements()
+        names = set(names_in(statements))
+        assigned = {statement.lvalue().getText().strip("()") for statement in descendants(statements, StornParser.SetStmtContext)}
+        parameters = self.visitTypedParamList(routine_ctx.typedParamList())
+        local_scope, _ = self.visitLocalVars(routine_ctx.localVars())
+        scope = {}
+        frame_size = self.frame_size
+        for name, type_ in [*parameters.items(), *local_scope.items()]:
+            self.frame_size += type_.size
+            type_.calculate_offset(self.frame_size)
+            scope[name] = type_
+        self.frame_size += routine.return_type.size
+        return_offset = self.frame_size
+        self.frame_peak = max(self.frame_peak, self.frame_size)
+
+        # Arguments the body never refers to are only evaluated, unless
+        # they're on the stack and have to be popped anyway. Constant
+        # arguments to parameters the body never sets are used as they are
+        constants = {}
+        arguments = ctx.parameters().expression()
+        for argument, (name, expected_parameter_type) in zip(reversed(arguments), reversed(routine.parameters.items())):
+            argument_type = self.visitExpression(argument)
+            if argument_type != expected_parameter_type:
+                raise CompileError("Parameter expression is an inconsistent type with routine expectation", argument.start.line, argument.start.column)
+            operand = self.operands[-1]
+            if name not in names and (operand.registers is not None or operand.constant is not None):
+                self.pop_operand()
+                continue
+            if operand.constant is not None and isinstance(argument_type, BaseType) and name not in assigned and name not in local_scope:
+                constants[name] = (argument_type, self.pop_operand().constant)
+                del scope[name]
+                continue
+            self.result_frame_address(-scope[name].offset)
+            self.store_operand()
+
+        caller = self.current_routine
+        inlined = Routine({}, routine.return_type, scope, False)
+        inlined.constants = constants
+        inlined.callees = caller.callees
+        inlined.global_references = caller.global_references
+        inlined.runtime_routines = caller.runtime_routines
+        end_label = f"L{self.label_count}"
+        self.label_count += 1
+        inlined.inline = (end_label, return_offset)
+        self.current_routine = inlined
+
+        returns = descendants(statements, StornParser.ReturnStmtContext)
+        statements = statements.statement()
+        if len(returns) == 1 and statements[-1].returnStmt() is returns[0] and (returns[0].expression() or routine.return_type.size == 0):
+            for statement in statements[:-1]:
+                self.visit(statement)
+            if returns[0].expression():
+                self.visitExpression(returns[0].expression())
+            else:
+                self.result_on_stack(0)
+        else:
+            self.visitStatements(routine_ctx.statements())
+            if self.instructions[-1] == ("jmp", end_label):
+                self.instructions.pop()
+            self.instructions += [
+                Label(end_label),
+            ]
+            if routine.return_type.size > 0:
+                self.result_frame_address(-return_offset)
+                self.load(routine.return_type)
+            else:
+                self.result_on_stack(0)
+
+        self.current_routine = caller
+        self.frame_size = frame_size
+        return routine.return_type
+
     def visitOutputStmt(self, ctx: StornParser.OutputStmtContext):
-        expression = self.visitExpression(ctx.expression())
+        self.visitExpression(ctx.expression())
 
-        self.instructions += [
-            f"ldr c {expression.size}",
-            f"L{self.label_count}:",
-            "ldr a c",
-            f"jmp zf L{self.label_count + 1}",
-            "dec",
-            "ldr c a",
-            "pop a",
-            "out",
-            f"jmp L{self.label_count}",
-            f"L{self.label_count + 1}:",
-        ]
-        self.label_count += 2
+        if 2 < self.operands[-1].size <= self.unroll_limit:
+            size = self.pop_operand().size
+            self.instructions += [("pop", "a"), ("out",)] * size
+            return
+        if self.operands[-1].size > 2:
+            size = self.pop_operand().size
+            self.instructions += [
+                ("ldr", "c", size),
+                Label(f"L{self.label_count}"),
+                ("ldr", "a", "c"),
+                ("jmp", "zf", f"L{self.label_count + 1}"),
+                ("dec",),
+                ("ldr", "c", "a"),
+                ("pop", "a"),
+                ("out",),
+                ("jmp", f"L{self.label_count}"),
+                Label(f"L{self.label_count + 1}"),
+            ]
+            self.label_count += 2
+            return
+
+        # Lowest byte first, as if popped from the stack
+        value = self.pop_value()
+        for byte in reversed(value.bytes()):
+            self.instructions += [
+                ("ldr", "a", byte),
+                ("out",),
+            ]
 
     def visitReturnStmt(self, ctx: StornParser.ReturnStmtContext):
+        if self.current_routine.inline is not None:
+            end_label, return_offset = self.current_routine.inline
+            if ctx.expression():
+                self.visitExpression(ctx.expression())
+                self.result_frame_address(-return_offset)
+                self.store_operand()
+            self.instructions += [
+                ("jmp", end_label),
+            ]
+            return
+
         if self.current_routine.is_entry and self.is_main:
             self.instructions += [
-                "hlt",
+                ("hlt",),
             ]
             return
 
+        call = only_call(ctx.expression()) if ctx.expression() else None
+        if call is not None and not self.current_routine.is_entry and self.tail_call(call):
+            return
+
         if ctx.expression():
             expression_type = self.visitExpression(ctx.expression())
             if expression_type != self.current_routine.return_type:
                 raise CompileError("Return type doesn't matched expectation for routine", ctx.expression().start.line, ctx.expression().start.column)
+            # Left in BC for the caller
+            if self.current_routine.registers:
+                value = self.pop_value()
+                self.move([(value, RESULT_REGISTERS[-value.size:])])
+            else:
+                # Store expression result to caller-allocated return space on stack
+                # Start of caller-allocated return space is at: BP + 1 (caller BPH) + 2 (return addr) + param size
+                # | 0x0000 |
+                # |  ....  |
+                # | LOCAL1 | <- SP
+                # | LOCAL0 | <- local 0 offset
+                # | BPL    | <- BP points here
+                # | BPH    |
+                # | RETURN | <- return low
+                # | RETURN | <- return high
+                # | PARAM0 | <- param 0 offset
+                # | PARAM0 |
+                # | PARAM0 |
+                # | PARAM1 | <- param 1 offset
+                # | RETVAL | <- return value space highest byte
+                # | RETVAL |
+                # | RETVAL | <- return value space lowest byte
+                # |  ....  |
+                # | 0xFFFF |
+                total_parameter_size = sum([
+                    param.size
+                    for param in self.current_routine.parameters.values()
+                ])
+                self.result_frame_address(total_parameter_size + 4)
+                self.store_operand()
+
+        # Epilogue: mov sp bp, pop bp, pop m (return), jmp m
+        self.instructions += [
+            *self.leave_frame(),
+            *([("irt",)] if self.current_routine.is_entry and not self.is_main else [("pop", "l"), ("pop", "h"), ("jmp", "m")]),
+        ]
+
+    # Expression results are tracked on an operand stack mirroring the one at
+    # runtime. A result stays in registers until something overwrites them,
+    # at which point it's spilled by inserting pushes where it was computed,
+    # so only values under register pressure go through memory
+    def result_in(self, *registers: str):
+        self.operands.append(Operand(len(registers), registers=registers, position=len(self.instructions)))
+
+    def result_constant(self, size: int, constant: int):
+        self.operands.append(Operand(size, constant=constant))
 
-            # Pop expression result from stack to caller-allocated return space on stack
-            # Start of caller-allocated return space is at: BP + 1 (caller BPH) + 2 (return addr) + param size
-            # Pop and increment
-            # | 0x0000 |
-            # |  ....  |
-            # | LOCAL1 | <- SP
-            # | LOCAL0 | <- local 0 offset
-            # | BPL    | <- BP points here
-            # | BPH    |
-            # | RETURN | <- return low
-            # | RETURN | <- return high
-            # | PARAM0 | <- param 0 offset
-            # | PARAM0 |
-            # | PARAM0 |
-            # | PARAM1 | <- param 1 offset
-            # | RETVAL | <- return value space highest byte
-            # | RETVAL |
-            # | RETVAL | <- return value space lowest byte
-            # |  ....  |
-            # | 0xFFFF |
-            total_parameter_size = sum([
-                param.size
-                for param in self.current_routine.parameters.values()
-            ])
-            offset = total_parameter_size + 4
-            offset_low = offset & 0b11111111
-            offset_high = offset >> 8
+    def result_on_stack(self, size: int):
+        self.operands.append(Operand(size))
 
+    def result_from_a(self):
+        register, = self.allocate(1)
+        self.instructions += [
+            ("ldr", register, "a"),
+        ]
+        self.result_in(register)
+
+    def clobbered(self, operand: Operand) -> bool:
+        for line in self.instructions[operand.position:]:
+            if isinstance(line, Label):
+                continue
+            if line[0] == "cal": # routines don't preserve registers other than BP
+                if operand.registers != ("bph", "bpl"):
+                    return True
+                continue
+            if effects(line)[1] & set(operand.registers):
+                return True
+        return False
+
+    # Pushing where the operand was computed keeps the stack in the same
+    # order as the operand stack, since newer operands are pushed later
+    def spill(self, index: int):
+        operand = self.operands[index]
+        pushes = [("psh", register) for register in operand.registers]
+        self.instructions[operand.position:operand.position] = pushes
+        for newer in self.operands[index + 1:]:
+            newer.position += len(pushes)
+        self.marks = [mark + len(pushes) if mark >= operand.position else mark for mark in self.marks]
+        self.operands[index] = Operand(operand.size, offset=operand.offset)
+
+    def spill_clobbered(self):
+        for index, operand in enumerate(self.operands):
+            if operand.registers is not None and self.clobbered(operand):
+                self.spill(index)
+
+    # Registers not holding an operand, spilling the deepest operands if
+    # there aren't enough
+    def allocate(self, size: int, avoid: Tuple = ()) -> Tuple[str, ...]:
+        self.spill_clobbered()
+        while True:
+            used = set(avoid)
+            for operand in self.operands:
+                used.update(operand.registers or ())
+            free = [register for register in EXPRESSION_REGISTERS if register not in used]
+            if len(free) >= size:
+                return tuple(free[:size])
+            held = [index for index, operand in enumerate(self.operands) if operand.registers is not None]
+            if not held:
+                raise Exception("Not enough registers to evaluate expression")
+            self.spill(held[0])
+
+    def pop_operand(self) -> Operand:
+        self.spill_clobbered()
+        return self.operands.pop()
+
+    # Pops the top operand, moving it into registers if it's on the stack
+    def pop_value(self, avoid: Tuple = ()) -> Operand:
+        operand = self.pop_operand()
+        if operand.registers is None and operand.constant is None:
+            registers = self.allocate(operand.size, avoid)
+            self.instructions += [("pop", register) for register in reversed(registers)]
+            operand = Operand(operand.size, registers=registers)
+        return operand
+
+    # Loads a constant into registers
+    def into_registers(self, operand: Operand, avoid: Tuple = ()) -> Tuple[str, ...]:
+        if operand.registers is not None:
+            return operand.registers
+        registers = self.allocate(operand.size, avoid)
+        self.instructions += [("ldr", register, byte) for register, byte in zip(registers, operand.bytes())]
+        return registers
+
+    # Pops the right then the left operand of a binary operation
+    def pop_operands(self) -> Tuple[Operand, Operand]:
+        right = self.pop_value()
+        left = self.pop_value(avoid=right.registers or ())
+        return left, right
+
+    # Pushes the top operand to the stack, eg. as a parameter
+    def push_operand(self):
+        operand = self.pop_operand()
+        if operand.registers is not None or operand.constant is not None:
+            self.instructions += [("psh", byte) for byte in operand.bytes()]
+
+    # Lvalues leave their address on the operand stack: a constant if it's
+    # known at compile time, otherwise BP or HL plus a constant offset, which
+    # is only added when the address is needed in HL
+    def result_frame_address(self, offset: int):
+        self.operands.append(Operand(2, registers=("bph", "bpl"), position=len(self.instructions), offset=offset))
+
+    def address_in_hl(self, address: Operand):
+        if address.constant is not None:
             self.instructions += [
-                "ldr a bpl",
-                f"add {offset_low}",
-                "ldr l a",
-                "ldr a bph",
-                f"add cc {offset_high}",
-                "ldr h a",
-                f"ldr c {self.current_routine.return_type.size}",
-                f"L{self.label_count}:",
-                "ldr a c",
-                f"jmp zf L{self.label_count + 1}",
-                "dec",
-                "ldr c a",
-                "pop a",
-                "str m a",
-                "ldr a l",
-                "inc",
-                "ldr l a",
-                "ldr a h",
-                "inc cc",
-                "ldr h a",
-                f"jmp L{self.label_count}",
-                f"L{self.label_count + 1}:",
+                ("ldr", "l", address.constant & 0b11111111),
+                ("ldr", "h", address.constant >> 8),
             ]
-            self.label_count += 2
+            return
+        if address.registers == ("bph", "bpl"):
+            # HL := BP +/- offset
+            operation = "add" if address.offset >= 0 else "sub"
+            offset = abs(address.offset)
+            self.instructions += [
+                ("ldr", "a", "bpl"),
+                (operation, offset & 0b11111111),
+                ("ldr", "l", "a"),
+                ("ldr", "a", "bph"),
+                (operation, "cc", offset >> 8),
+                ("ldr", "h", "a"),
+            ]
+            return
+        if address.registers is None:
+            self.instructions += [
+                ("pop", "l"),
+                ("pop", "h"),
+            ]
+        self.instructions += self.offset_hl(address.offset)
 
-        # Epilogue: mov sp bp, pop bp, pop m (return), jmp m
+    # Adds a constant offset to the address on top of the operand stack
+    def offset_address(self, offset: int):
+        address = self.operands[-1]
+        if address.constant is not None:
+            address.constant = (address.constant + offset) & 0xFFFF
+        else:
+            address.offset += offset
+
+    # HL := HL + offset
+    def offset_hl(self, offset: int) -> List[Line]:
+        offset &= 0xFFFF
+        if offset == 0:
+            return []
+        return [
+            ("ldr", "a", "l"),
+            ("add", offset & 0b11111111),
+            ("ldr", "l", "a"),
+            ("ldr", "a", "h"),
+            ("add", "cc", offset >> 8),
+            ("ldr", "h", "a"),
+        ]
+
+    # Sets the zero flag when the value is zero
+    def zero_test(self, value: Operand) -> List[Line]:
+        first, *rest = value.bytes()
+        return [("ldr", "a", first), *[("or", byte) for byte in rest]]
+
+    # Constant conditions are decided at compile time
+    def jump_if_zero(self, label: str):
+        value = self.pop_value()
+        if value.constant is not None:
+            if value.constant == 0:
+                self.instructions += [
+                    ("jmp", label),
+                ]
+            return
         self.instructions += [
-            "ldr sph bph",
-            "ldr spl bpl",
-            "pop bpl",
-            "pop bph",
-            *([f"pop {register}" for register in reversed(STATUS_REGISTERS)] if self.current_routine.is_entry and not self.is_main else []),
-            *(["irt"] if self.current_routine.is_entry and not self.is_main else ["pop l", "pop h", "jmp m"]),
+            *self.zero_test(value),
+            ("jmp", "zf", label),
+        ]
+
+    # Shifts a value in registers by one bit
+    def shift(self, value: Tuple[str, ...], operation_instruction: Tuple[str]) -> List[Line]:
+        if len(value) == 1:
+            return [
+                ("ldr", "a", value[0]),
+                operation_instruction,
+                ("ldr", value[0], "a"),
+            ]
+        # whether to shift the high or low byte first depends on direction
+        high, low = value
+        first, second = (high, low) if operation_instruction == ("shr",) else (low, high)
+        return [
+            ("ldr", "a", first),
+            operation_instruction,
+            ("ldr", first, "a"),
+            ("ldr", "a", second),
+            (*operation_instruction, "cc"),
+            ("ldr", second, "a"),
         ]
 
+    # Evaluates operations on constants at compile time, returning whether it did
+    def fold(self, operands: List[Operand], size: int, function) -> bool:
+        if any(operand.constant is None for operand in operands):
+            return False
+        result = function(*[operand.constant for operand in operands])
+        self.result_constant(size, int(result) & ((1 << (8 * size)) - 1))
+        return True
+
+    # Applies an operation per byte pair through A, lowest byte first, writing
+    # each byte of the result over the operand's once it has been read
+    def bytewise(self, left: Operand, right: Operand, operations: List[Tuple]):
+        destination = left.registers or right.registers or self.allocate(left.size)
+        for operation, left_byte, right_byte, register in zip(operations, reversed(left.bytes()), reversed(right.bytes()), reversed(destination)):
+            self.instructions += [
+                ("ldr", "a", left_byte),
+                (*operation, right_byte),
+                ("ldr", register, "a"),
+            ]
+        self.result_in(*destination)
+
     def visitExpression(self, ctx: StornParser.ExpressionContext) -> Type:
         return self.visitLogicalExpr(ctx.logicalExpr())
 
     def visitLogicalExpr(self, ctx: StornParser.LogicalExprContext) -> Type:
-        expression = self.visitBitwiseExpr(ctx.bitwiseExpr(0))
+        if not ctx.logicalOp():
+            return self.visitBitwiseExpr(ctx.bitwiseExpr(0))
 
-        bitwise_count = (ctx.getChildCount() - 1) // 2
-        for i in range(bitwise_count):
-            if not isinstance(expression, BaseType):
-                raise CompileError("Attempting to perform logical operation on non numerical type", ctx.bitwiseExpr(i).start.line, ctx.bitwiseExpr(i).start.line)
-            next_expression = self.visitBitwiseExpr(ctx.bitwiseExpr(i + 1))
+        true_label = f"L{self.label_count}"
+        false_label = f"L{self.label_count + 1}"
+        self.label_count += 2
+        expression, constant = self.logical_branches(ctx, true_label, false_label, as_value=True)
+        if constant is not None:
+            self.result_constant(expression.width // 8, int(constant))
+            return expression
+
+        # Every jump to the false label follows a zero test or loads zero, so
+        # A is already 0 there
+        self.instructions += [
+            Label(true_label),
+            ("ldr", "a", 1),
+            Label(false_label),
+        ]
+        if expression.width == 8:
+            self.result_from_a()
+        else:
+            high, low = self.allocate(2)
+            self.instructions += [
+                ("ldr", low, "a"),
+                ("ldr", high, 0),
+            ]
+            self.result_in(high, low)
+        return expression
+
+    # Compiles a chain of `and`/`or` (left to right, without precedence) as
+    # branches that short-circuit: once an operand decides the chain so far,
+    # the operands that can't change it are jumped over. The chain falls
+    # through or jumps to `true_label`, which the caller places after it, if
+    # it's true and jumps to `false_label` otherwise. For a chain used
+    # `as_value`, A is zero wherever it jumps to `false_label`. Returns the
+    # operands' type and, if every operand was constant, the chain's value,
+    # in which case no code is emitted
+    def logical_branches(self, ctx: StornParser.LogicalExprContext, true_label: str, false_label: str, as_value: bool) -> Tuple[Type, Optional[bool]]:
+        count = len(ctx.logicalOp())
+        is_and = [operation.AND() is not None for operation in ctx.logicalOp()]
+        starts = [f"L{self.label_count + k}" for k in range(count + 1)]
+        self.label_count += count + 1
+
+        # Where to go once the chain up to operand k is known to be `value`:
+        # the next operand whose operation that doesn't decide
+        def skip_to(k: int, value: bool) -> str:
+            for j in range(k + 1, count + 1):
+                if is_and[j - 1] == value:
+                    return starts[j]
+            return true_label if value else false_label
+
+        # Jumps for a chain decided to be `value` after operand k
+        def decided(k: int, value: bool) -> List[Line]:
+            return [*([("ldr", "a", 0)] if as_value and not value else []), ("jmp", skip_to(k, value))]
+
+        targets = {skip_to(k, not is_and[k]) for k in range(count)}
+        expression = None
+        # The chain's value so far while every operand has been constant
+        known = None
+        for k in range(count + 1):
+            skip = []
+            self.marks.append(len(self.instructions))
+            if k > 0 and known is not None and is_and[k - 1] != known:
+                # Only needed if this operand turns out not to be constant
+                skip = decided(k - 1, known)
+            elif k > 0 and known is None and starts[k] in targets:
+                skip = [Label(starts[k])]
+            self.instructions += skip
+
+            # Operands of an `and` decide the chain when they're false, as
+            # does the last one, and operands of an `or` when they're true
+            when = k < count and not is_and[k]
+            operand_ctx = ctx.bitwiseExpr(k)
+            next_expression, constant = self.branch(operand_ctx, skip_to(k, when), when, fuse=not as_value)
+            skip_index = self.marks.pop()
             if not isinstance(next_expression, BaseType):
-                raise CompileError("Attempting to perform logical operation on non numerical type", ctx.bitwiseExpr(i + 1).start.line, ctx.bitwiseExpr(i + 1).start.column)
-            if expression.width != next_expression.width:
-                raise CompileError("Attempting to perform logical operation on expressions of differing width", ctx.logicalOp(i).start.line, ctx.logicalOp(i).start.column)
+                raise CompileError("Attempting to perform logical operation on non numerical type", operand_ctx.start.line, operand_ctx.start.column)
+            if expression is not None and expression.width != next_expression.width:
+                raise CompileError("Attempting to perform logical operation on expressions of differing width", ctx.logicalOp(k - 1).start.line, ctx.logicalOp(k - 1).start.column)
+            expression = next_expression
 
-            operation = ctx.logicalOp(i)
-            width = expression.width
-            if operation.AND():
-                operation_instruction = "and b"
+            if constant is not None and (k == 0 or known is not None):
+                if k == 0 or is_and[k - 1] == known:
+                    known = constant
+                else:
+                    # The operand's own code is skipped along with it, even
+                    # if it only folded to a constant after emitting some.
+                    # Pushes spilling older operands come before the skip
+                    del self.instructions[skip_index:]
+                continue
+            known = None
+            if constant == when:
+                self.instructions += decided(k, when)
+
+        return expression, known
+
+    # Evaluates an operand of a condition and jumps to `label` if its truth
+    # is `when`. A comparison is tested by its subtraction if `fuse` is set,
+    # and any other value by a zero test, leaving A zero if `when` is false.
+    # Returns the operand's type and, if it's constant, its truth, in which
+    # case nothing is emitted
+    def branch(self, ctx: StornParser.BitwiseExprContext, label: str, when: bool, fuse: bool) -> Tuple[Type, Optional[bool]]:
+        inner_ctx = parenthesised(ctx)
+        if fuse and inner_ctx is not None:
+            logical_ctx = inner_ctx.logicalExpr()
+            if not logical_ctx.logicalOp():
+                return self.branch(logical_ctx.bitwiseExpr(0), label, when, fuse)
+            # A nested chain jumps straight to `label` too
+            other_label = f"L{self.label_count}"
+            self.label_count += 1
+            if when:
+                expression, constant = self.logical_branches(logical_ctx, label, other_label, as_value=False)
+                jump = [("jmp", label)]
             else:
-                operation_instruction = "or b"
-            if width == 8:
+                expression, constant = self.logical_branches(logical_ctx, other_label, label, as_value=False)
+                jump = []
+            if constant is None:
                 self.instructions += [
-                    "pop a",
-                    f"jmp nzf L{self.label_count}",
-                    "ldr b a", # ie. ldr b 0
-                    f"jmp L{self.label_count + 1}",
-                    f"L{self.label_count}:",
-                    "ldr b 1",
-                    f"L{self.label_count + 1}:",
-                    "pop a",
-                    f"jmp zf L{self.label_count + 2}",
-                    "ldr a 1",
-                    f"L{self.label_count + 2}:",
-                    operation_instruction,
-                    f"jmp nzf L{self.label_count + 3}",
-                    "psh 0",
-                    f"jmp L{self.label_count + 4}",
-                    f"L{self.label_count + 3}:",
-                    "psh 1",
-                    f"L{self.label_count + 4}:",
+                    *jump,
+                    Label(other_label),
                 ]
-                self.label_count += 5
-            elif width == 16:
-                self.instructions += [
-                    "pop a",
-                    f"jmp nzf L{self.label_count}",
-                    "pop a",
-                    f"jmp nzf L{self.label_count}",
-                    "ldr b 0",
-                    f"jmp L{self.label_count + 1}",
-                    f"L{self.label_count}:",
-                    "ldr b 1",
-                    f"L{self.label_count + 1}",
-                    "pop a",
-                    f"jmp nzf L{self.label_count + 2}",
-                    "pop a",
-                    f"jmp L{self.label_count + 3}",
-                    f"L{self.label_count + 2}:",
-                    "ldr a 1",
-                    f"L{self.label_count + 3}:",
-                    operation_instruction,
-                    f"jmp nzf L{self.label_count + 4}",
-                    "psh 0",
-                    "psh 0",
-                    f"jmp L{self.label_count + 5}",
-                    f"L{self.label_count + 4}:",
-                    "psh 0",
-                    "psh 1",
-                    f"L{self.label_count + 5}",
-                ]
-                self.label_count += 6
-            expression = next_expression
-
-        return expression
+            return expression, constant
+
+        comparative_ctx = ctx.comparativeExpr(0)
+        if fuse and not ctx.bitwiseOp() and len(comparative_ctx.comparativeOp()) == 1:
+            expression = self.visitArithmeticExpr(comparative_ctx.arithmeticExpr(0))
+            next_expression = self.visitArithmeticExpr(comparative_ctx.arithmeticExpr(1))
+            self.check_comparison(comparative_ctx, 0, expression, next_expression)
+            minuend, subtrahend, flag = self.comparison_operands(comparative_ctx.comparativeOp(0))
+            if minuend.constant is not None and subtrahend.constant is not None:
+                return expression, compare(expression.width, flag, minuend.constant, subtrahend.constant)
+            self.instructions += self.compare_branch(minuend, subtrahend, flag, label, when)
+            return expression, None
+
+        expression = self.visitBitwiseExpr(ctx)
+        if not isinstance(expression, BaseType):
+            return expression, None
+        value = self.pop_value()
+        if value.constant is not None:
+            return expression, value.constant != 0
+        self.instructions += [
+            *self.zero_test(value),
+            ("jmp", "nzf" if when else "zf", label),
+        ]
+        return expression, None
 
     def visitBitwiseExpr(self, ctx: StornParser.BitwiseExprContext) -> Type:
         expression = self.visitComparativeExpr(ctx.comparativeExpr(0))
@@ -917,40 +1649,17 @@ class CodeGenerator(StornVisitor):
             operation = ctx.bitwiseOp(i)
             width = expression.width
             if operation.DIS():
-                operation_instruction = "or b"
+                operation_instruction = ("or",)
+                function = lambda x, y: x | y
             elif operation.CON():
-                operation_instruction = "and b"
+                operation_instruction = ("and",)
+                function = lambda x, y: x & y
             else:
-                operation_instruction = "xor b"
-            if width == 8:
-                self.instructions += [
-                    "pop b",
-                    "pop a",
-                    operation_instruction,
-                    "psh a",
-                ]
-            elif width == 16:
-                # for x:16 & y:16,
-                # Stack is:
-                # | Y LOW  | <- top of stack
-                # | Y HIGH |
-                # | X LOW  |
-                # | X HIGH |
-                # and we want to finish with stack like:
-                # | Y LOW & X LOW   | <- top of stack
-                # | Y HIGH & X HIGH |
-                self.instructions += [
-                    "pop b",
-                    "pop c",
-                    "pop a",
-                    operation_instruction,
-                    "ldr b c",
-                    "ldr c a",
-                    "pop a",
-                    operation_instruction,
-                    "psh a",
-                    "psh c",
-                ]
+                operation_instruction = ("xor",)
+                function = lambda x, y: x ^ y
+            left, right = self.pop_operands()
+            if not self.fold([left, right], width // 8, function):
+                self.bytewise(left, right, [operation_instruction] * (width // 8))
             expression = next_expression
 
         return expression
@@ -960,96 +1669,105 @@ class CodeGenerator(StornVisitor):
 
         arithmetic_count = (ctx.getChildCount() - 1) // 2
         for i in range(arithmetic_count):
-            if not isinstance(expression, BaseType):
-                raise CompileError("Attempting to perform comparative operation on non numerical type", ctx.arithmeticExpr(i).start.line, ctx.arithmeticExpr(i).start.column)
             next_expression = self.visitArithmeticExpr(ctx.arithmeticExpr(i + 1))
-            if not isinstance(next_expression, BaseType):
-                raise CompileError("Attempting to perform comparative operation on non numerical type", ctx.arithmeticExpr(i + 1).start.line, ctx.arithmeticExpr(i + 1).start.column)
-            if expression.width != next_expression.width:
-                raise CompileError("Attempting to perform comparative operation on expressions of differing width", ctx.comparativeOp(i).start.line, ctx.comparativeOp(i).start.column)
+            self.check_comparison(ctx, i, expression, next_expression)
 
-            operation = ctx.comparativeOp(i)
             width = expression.width
+            minuend, subtrahend, flag = self.comparison_operands(ctx.comparativeOp(i))
+            if self.fold([minuend, subtrahend], width // 8, lambda x, y: compare(width, flag, x, y)):
+                expression = next_expression
+                continue
 
-            # Between the 10 cases (5 operations; 2 'widths'), only 2
-            # operations are changing, namely, (i) the order of the
-            # subtraction performed and (ii) the flag that is tested.
-            # All 5 operations can be summarised here:
-            # x = y  holds when y - x triggers zf
-            # x < y  holds when x - y triggers sf
-            # x > y  holds when y - x triggers sf
-            # x <= y holds when y - x triggers nsf
-            # x >= y holds when x - y triggers nsf
-            pop_ops = ["pop b", "pop a"] # x - y
-            if operation.EQ() or operation.GT() or operation.LEQ():
-                pop_ops = ["pop a", "pop b"]
-            flag: Literal["zf", "sf", "nsf"] = "zf"
-            if operation.LT() or operation.GT():
-                flag = "sf"
-            if operation.LEQ() or operation.GEQ():
-                flag = "nsf"
-
-            if width == 8:
-                self.instructions += [
-                    *pop_ops,
-                    "sub b",
-                    f"jmp {flag} L{self.label_count}",
-                    "psh 0",
-                    f"jmp L{self.label_count + 1}",
-                    f"L{self.label_count}:",
-                    "psh 1",
-                    f"L{self.label_count + 1}:",
-                ]
-                self.label_count += 2
-            elif width == 16: # separated into zf (EQ) and sf comparisons
-                if operation.EQ():
-                    # x - y
-                    self.instructions += [
-                        "pop b", # y low
-                        "pop h", # y high
-                        "pop a", # x low
-                        "sub b", # x low - y low
-                        f"jmp nzf L{self.label_count}",
-                        "pop a", # x high
-                        "sub h", # x high - y high
-                        f"jmp zf L{self.label_count + 1}",
-                        f"L{self.label_count}:",
-                        "psh 0",
-                        "psh 0",
-                        f"jmp L{self.label_count + 2}",
-                        f"L{self.label_count + 1}:",
-                        "psh 0",
-                        "psh 1",
-                        f"L{self.label_count + 2}:",
-                    ]
-                    self.label_count += 3
-                else:
-                    self.instructions += [
-                        pop_ops[0],
-                        "pop h",
-                        pop_ops[1],
-                        "sub b",
-                        pop_ops[1],
-                        f"ldr {pop_ops[0][-1]} h", # get register name
-                        "sub cc b",
-                        f"jmp {flag} L{self.label_count}",
-                        "psh 0",
-                        "psh 0",
-                        f"jmp L{self.label_count + 1}",
-                        f"L{self.label_count}:",
-                        "psh 0",
-                        "psh 1",
-                        f"L{self.label_count + 1}:",
-                    ]
-                    self.label_count += 2
+            true_label = self.label_count
+            final_label = self.label_count + 1
+            self.label_count += 2
+            self.instructions += self.compare_branch(minuend, subtrahend, flag, f"L{true_label}", True)
+            result = self.allocate(width // 8)
+            self.instructions += [
+                *[("ldr", register, 0) for register in result],
+                ("jmp", f"L{final_label}"),
+                Label(f"L{true_label}"),
+                *[("ldr", register, 0) for register in result[:-1]],
+                ("ldr", result[-1], 1),
+                Label(f"L{final_label}"),
+            ]
+            self.result_in(*result)
 
             expression = next_expression
 
         return expression
 
+    def check_comparison(self, ctx: StornParser.ComparativeExprContext, i: int, expression: Type, next_expression: Type):
+        if not isinstance(expression, BaseType):
+            raise CompileError("Attempting to perform comparative operation on non numerical type", ctx.arithmeticExpr(i).start.line, ctx.arithmeticExpr(i).start.column)
+        if not isinstance(next_expression, BaseType):
+            raise CompileError("Attempting to perform comparative operation on non numerical type", ctx.arithmeticExpr(i + 1).start.line, ctx.arithmeticExpr(i + 1).start.column)
+        if expression.width != next_expression.width:
+            raise CompileError("Attempting to perform comparative operation on expressions of differing width", ctx.comparativeOp(i).start.line, ctx.comparativeOp(i).start.column)
+
+    # Pops the operands of a comparison, returning them in the order they're
+    # subtracted in with the flag that's set if the comparison holds.
+    # Between the 10 cases (5 operations; 2 'widths'), only 2
+    # operations are changing, namely, (i) the order of the
+    # subtraction performed and (ii) the flag that is tested.
+    # All 5 operations can be summarised here:
+    # x = y  holds when y - x triggers zf
+    # x < y  holds when x - y triggers sf
+    # x > y  holds when y - x triggers sf
+    # x <= y holds when y - x triggers nsf
+    # x >= y holds when x - y triggers nsf
+    def comparison_operands(self, operation: StornParser.ComparativeOpContext) -> Tuple[Operand, Operand, Literal["zf", "sf", "nsf"]]:
+        x, y = self.pop_operands()
+        minuend, subtrahend = x, y
+        if operation.EQ() or operation.GT() or operation.LEQ():
+            minuend, subtrahend = y, x
+        flag: Literal["zf", "sf", "nsf"] = "zf"
+        if operation.LT() or operation.GT():
+            flag = "sf"
+        if operation.LEQ() or operation.GEQ():
+            flag = "nsf"
+        return minuend, subtrahend, flag
+
+    # Subtracts and jumps to `label` if the comparison's result is `when`
+    def compare_branch(self, minuend: Operand, subtrahend: Operand, flag: str, label: str, when: bool) -> List[Line]:
+        condition = flag if when else NEGATED_CONDITIONS[flag]
+        if minuend.size == 1:
+            return [
+                ("ldr", "a", minuend.bytes()[0]),
+                ("sub", subtrahend.bytes()[0]),
+                ("jmp", condition, label),
+            ]
+        minuend_high, minuend_low = minuend.bytes()
+        subtrahend_high, subtrahend_low = subtrahend.bytes()
+        if flag != "zf":
+            return [
+                ("ldr", "a", minuend_low),
+                ("sub", subtrahend_low),
+                ("ldr", "a", minuend_high),
+                ("sub", "cc", subtrahend_high),
+                ("jmp", condition, label),
+            ]
+        # Equal only if both bytes are, so a differing low byte decides it
+        low_differs = label
+        if when:
+            low_differs = f"L{self.label_count}"
+            self.label_count += 1
+        return [
+            ("ldr", "a", minuend_low),
+            ("sub", subtrahend_low),
+            ("jmp", "nzf", low_differs),
+            ("ldr", "a", minuend_high),
+            ("sub", subtrahend_high),
+            ("jmp", condition, label),
+            *([Label(low_differs)] if when else []),
+        ]
+
     def visitArithmeticExpr(self, ctx: StornParser.ArithmeticExprContext) -> Type:
         expression = self.visitShiftExpr(ctx.shiftExpr(0))
 
+        # Constant terms are summed at compile time and added once at the end,
+        # eg. x + 1:8 - 3:8 is computed as x - 2:8
+        offset = 0
         shift_count = (ctx.getChildCount() - 1) // 2
         for i in range(shift_count):
             if not (isinstance(expression, BaseType) or isinstance(expression, ReferenceType)):
@@ -1068,29 +1786,24 @@ class CodeGenerator(StornVisitor):
             width = expression.width if isinstance(expression, BaseType) else 16
             if operation.PLUS():
                 operation_instruction = "add"
+                sign = 1
             else:
                 operation_instruction = "sub"
-            if width == 8:
-                self.instructions += [
-                    "pop b",
-                    "pop a",
-                    f"{operation_instruction} b",
-                    "psh a",
-                ]
-            elif width == 16:
-                self.instructions += [
-                    "pop l",
-                    "pop h",
-                    "pop a",
-                    f"{operation_instruction} l",
-                    "ldr l a",
-                    "pop a",
-                    f"{operation_instruction} cc h",
-                    "psh a",
-                    "psh l",
-                ]
+                sign = -1
+            if self.operands[-1].constant is not None:
+                offset += sign * self.pop_operand().constant
+            else:
+                left, right = self.pop_operands()
+                # The high byte takes the low byte's carry
+                self.bytewise(left, right, [(operation_instruction,), (operation_instruction, "cc")][:width // 8])
             expression = next_expression
 
+        if offset != 0:
+            value = self.pop_value()
+            if not self.fold([value], value.size, lambda x: x + offset):
+                operation_instruction = "add" if offset > 0 else "sub"
+                self.bytewise(value, Operand(value.size, constant=abs(offset)), [(operation_instruction,), (operation_instruction, "cc")][:value.size])
+
         return expression
 
     def visitShiftExpr(self, ctx: StornParser.ShiftExprContext) -> Type:
@@ -1109,61 +1822,66 @@ class CodeGenerator(StornVisitor):
             operation = ctx.shiftOp(i)
             width = expression.width
             if operation.SHR():
-                operation_instruction = "shr"
+                operation_instruction = ("shr",)
             else:
-                operation_instruction = "shl"
-            if width == 8:
-                self.instructions += [
-                    "pop c",
-                    "pop b",
-                    f"L{self.label_count}:",
-                    "ldr a c",
-                    f"jmp zf L{self.label_count + 1}",
-                    "ldr a b",
-                    operation_instruction,
-                    "ldr b a",
-                    "ldr a c",
-                    "dec",
-                    "ldr c a",
-                    f"jmp L{self.label_count}",
-                    f"L{self.label_count + 1}:",
-                    "psh b",
-                ]
-                self.label_count += 2
-            elif width == 16:
-                self.instructions += [
-                    "pop c",
-                    "pop l",
-                    "pop h",
-                    f"L{self.label_count}:",
-                    "ldr a c",
-                    f"jmp zf L{self.label_count + 1}",
-                    *( # whether to shift h or l first depends on direction
-                        [
-                            "ldr a h",
-                            "shr",
-                            "ldr h a",
-                            "ldr a l",
-                            "shr cc",
-                            "ldr l a",
-                        ] if operation_instruction == "shr" else [
-                            "ldr a l",
-                            "shl",
-                            "ldr l a",
-                            "ldr a h",
-                            "shl cc",
-                            "ldr h a",
-                        ]
-                    ),
-                    "ldr a c",
-                    "dec",
-                    "ldr c a",
-                    f"jmp L{self.label_count}",
-                    f"L{self.label_count + 1}:",
-                    "psh h",
-                    "psh l",
-                ]
-                self.label_count += 2
+                operation_instruction = ("shl",)
+            count_operand = self.pop_value()
+            value_operand = self.pop_value(avoid=count_operand.registers or ())
+            if operation.SHR():
+                folded = self.fold([value_operand, count_operand], width // 8, lambda x, count: x >> count)
+            else:
+                folded = self.fold([value_operand, count_operand], width // 8, lambda x, count: x << count)
+            if folded:
+                if width == 8:
+                    expression = next_expression
+                continue
+
+            # Constant shifts are unrolled, moving whole bytes for shifts of 8 or more
+            if count_operand.constant is not None:
+                shift_count = count_operand.constant
+                if shift_count >= width:
+                    self.result_constant(width // 8, 0)
+                else:
+                    value = self.into_registers(value_operand)
+                    shifted = value
+                    if shift_count >= 8:
+                        high, low = value
+                        if operation.SHR():
+                            self.instructions += [
+                                ("ldr", low, high),
+                                ("ldr", high, 0),
+                            ]
+                            shifted = (low,)
+                        else:
+                            self.instructions += [
+                                ("ldr", high, low),
+                                ("ldr", low, 0),
+                            ]
+                            shifted = (high,)
+                        shift_count -= 8
+                    for _ in range(shift_count):
+                        self.instructions += self.shift(shifted, operation_instruction)
+                    self.result_in(*value)
+                if width == 8:
+                    expression = next_expression
+                continue
+
+            count, = self.into_registers(count_operand, avoid=value_operand.registers or ())
+            value = self.into_registers(value_operand, avoid=(count,))
+            shift = self.shift(value, operation_instruction)
+            self.instructions += [
+                Label(f"L{self.label_count}"),
+                ("ldr", "a", count),
+                ("jmp", "zf", f"L{self.label_count + 1}"),
+                *shift,
+                ("ldr", "a", count),
+                ("dec",),
+                ("ldr", count, "a"),
+                ("jmp", f"L{self.label_count}"),
+                Label(f"L{self.label_count + 1}"),
+            ]
+            self.label_count += 2
+            self.result_in(*value)
 
             if width == 8: # otherwise we return width 8 for width 16
                 expression = next_expression
@@ -1175,44 +1893,81 @@ class CodeGenerator(StornVisitor):
 
         unary_count = (ctx.getChildCount() - 1) // 2
         for i in range(unary_count):
-            if not (isinstance(expression, BaseType) and expression.width == 8):
-                raise CompileError("Attempting to multiply expression not of type [8]", ctx.unaryExpr(i).start.line, ctx.unaryExpr(i).start.column)
+            if not isinstance(expression, BaseType):
+                raise CompileError("Attempting to perform multiplicative operation on non numerical type", ctx.unaryExpr(i).start.line, ctx.unaryExpr(i).start.column)
             next_expression = self.visitUnaryExpr(ctx.unaryExpr(i + 1))
-            if not (isinstance(next_expression, BaseType) and next_expression.width == 8):
-                raise CompileError("Attempting to multiply expression not of type [8]", ctx.unaryExpr(i + 1).start.line, ctx.unaryExpr(i + 1).start.column)
+            if not isinstance(next_expression, BaseType):
+                raise CompileError("Attempting to perform multiplicative operation on non numerical type", ctx.unaryExpr(i + 1).start.line, ctx.unaryExpr(i + 1).start.column)
+            if expression.width != next_expression.width:
+                raise CompileError("Attempting to perform multiplicative operation on expressions of differing width", ctx.multiplicativeOp(i).start.line, ctx.multiplicativeOp(i).start.column)
 
-            self.instructions += [
-                "pop l", # multiplier
-                "pop b", # multiplicand
-                "ldr h 0",
-                "ldr c 8",
-                f"L{self.label_count}:",
-                "ldr a l",
-                "and 1",
-                f"jmp zf L{self.label_count + 1}",
-                "ldr a h",
-                "add b",
-                "ldr h a",
-                f"L{self.label_count + 1}:",
-                "ldr a h",
-                "shr cc",
-                "ldr h a",
-                "ldr a l",
-                "shr cc",
-                "ldr l a",
-                "ldr a c",
-                "dec",
-                "ldr c a",
-                f"jmp nzf L{self.label_count}",
-                "psh h",
-                "psh l",
-            ]
-            self.label_count += 2
+            operation = ctx.multiplicativeOp(i)
+            width = expression.width
+            mask = (1 << width) - 1
+            left, right = self.pop_operands()
+            # Unsigned, with division by zero giving all ones and leaving the
+            # dividend as the remainder, as the runtime routines do
+            if operation.TIMES():
+                # Multiplying 8 bit values widens to 16 bits
+                expression = BaseType(16)
+                folded = self.fold([left, right], 2, lambda x, y: x * y)
+            elif operation.DIVIDE():
+                folded = self.fold([left, right], width // 8, lambda x, y: x // y if y else mask)
+            else:
+                folded = self.fold([left, right], width // 8, lambda x, y: x % y if y else x)
+            if folded:
+                continue
 
-            expression = BaseType(16)
+            if width == 8:
+                self.call_runtime("mul8" if operation.TIMES() else "divmod8", [(left, ("b",)), (right, ("c",))])
+                if operation.MODULO():
+                    self.result_in("c")
+                elif operation.DIVIDE():
+                    self.result_in("b")
+                else:
+                    self.result_in("b", "c")
+            else:
+                routine = "mul16" if operation.TIMES() else "divmod16"
+                label = "__mul16" if operation.TIMES() else "__div16" if operation.DIVIDE() else "__mod16"
+                self.call_runtime(routine, [(left, ("b", "c")), (right, ("h", "l"))], label)
+                self.result_in("b", "c")
 
         return expression
 
+    # Moves arguments into the registers a runtime routine takes them in, then
+    # calls it
+    def call_runtime(self, routine: str, arguments: List[Tuple[Operand, Tuple[str, ...]]], label: Optional[str] = None):
+        self.move(arguments)
+        self.instructions += [
+            ("cal", label or f"__{routine}"),
+        ]
+        self.runtime_routines.add(routine)
+        self.current_routine.runtime_routines.add(routine)
+
+    # Moves values into the given registers. A move waits while its
+    # destination still has to be read, and if every remaining destination
+    # does, one is set aside in A
+    def move(self, arguments: List[Tuple[Operand, Tuple[str, ...]]]):
+        moves = {}
+        for operand, registers in arguments:
+            for register, byte in zip(registers, operand.bytes()):
+                if register != byte:
+                    moves[register] = byte
+        while moves:
+            sources = set(moves.values())
+            ready = [register for register in moves if register not in sources]
+            if not ready:
+                register = next(iter(moves))
+                self.instructions += [
+                    ("ldr", "a", register),
+                ]
+                moves = {destination: "a" if source == register else source for destination, source in moves.items()}
+                continue
+            for register in ready:
+                self.instructions += [
+                    ("ldr", register, moves.pop(register)),
+                ]
+
     def visitUnaryExpr(self, ctx: StornParser.UnaryExprContext) -> Type:
         if ctx.primaryExpr():
             expression = self.visitPrimaryExpr(ctx.primaryExpr())
@@ -1224,45 +1979,12 @@ class CodeGenerator(StornVisitor):
                 raise CompileError("Attempting to perform unary operation on non numerical type", ctx.MINUS().start.line, ctx.MINUS().start.column)
 
             width = expression.width
-            if ctx.MINUS():
-                if width == 8:
-                    self.instructions += [
-                        "ldr a 0",
-                        "pop b",
-                        "sub b",
-                        "psh a",
-                    ]
-                elif width == 16:
-                    self.instructions += [
-                        "ldr a 0",
-                        "pop b",
-                        "sub b",
-                        "ldr c a",
-                        "ldr a 0",
-                        "pop b",
-                        "sub cc b",
-                        "psh a",
-                        "psh c",
-                    ]
-            elif ctx.NOT():
-                if width == 8:
-                    self.instructions += [
-                        "pop a",
-                        "ldr b 255",
-                        "xor b",
-                        "psh a",
-                    ]
-                elif width == 16:
-                    self.instructions += [
-                        "pop a",
-                        "ldr b 255",
-                        "xor b",
-                        "ldr l a",
-                        "pop a",
-                        "xor b",
-                        "psh a",
-                        "psh l",
-                    ]
+            size = width // 8
+            value = self.pop_value()
+            if ctx.MINUS() and not self.fold([value], size, lambda x: -x): # 0 - x
+                self.bytewise(Operand(size, constant=0), value, [("sub",), ("sub", "cc")][:size])
+            elif ctx.NOT() and not self.fold([value], size, lambda x: ~x): # x ^ 0xFF..
+                self.bytewise(value, Operand(size, constant=(1 << width) - 1), [("xor",)] * size)
         elif ctx.type_():
             type_ = self.visitType(ctx.type_())
             if isinstance(expression, BaseType) and isinstance(type_, BaseType):
@@ -1272,18 +1994,21 @@ class CodeGenerator(StornVisitor):
                 if current_width == new_width:
                     return expression
 
+                value = self.pop_value()
                 if new_width == 8: # narrowing
-                    self.instructions += [
-                        "pop a",
-                        "pop b",
-                        "psh a",
-                    ]
+                    if value.constant is not None:
+                        self.result_constant(1, value.constant & 0b11111111)
+                    else:
+                        self.result_in(value.registers[-1])
                 elif new_width == 16: # promotion
-                    self.instructions += [
-                        "pop a",
-                        "psh 0",
-                        "psh a",
-                    ]
+                    if value.constant is not None:
+                        self.result_constant(2, value.constant)
+                    else:
+                        high, = self.allocate(1, avoid=value.registers)
+                        self.instructions += [
+                            ("ldr", high, 0),
+                        ]
+                        self.result_in(high, *value.registers)
 
                 return BaseType(new_width)
 
@@ -1301,70 +2026,29 @@ class CodeGenerator(StornVisitor):
             call_return_type = self.visitCall(ctx.call())
             return call_return_type
         elif ctx.lvalue():
+            # An inlined routine's parameter may be a constant, which can only
+            # be read since the routine never sets it
+            name = ctx.lvalue().getText().strip("()")
+            if name in self.current_routine.constants:
+                type_, constant = self.current_routine.constants[name]
+                self.result_constant(type_.size, constant)
+                return type_
             lvalue = self.visitLvalue(ctx.lvalue())
-
-            # Push bytes from memory range [HL, HL + (size - 1)] to stack
-            # Note that bytes are pushed in reverse order, starting from HL + (size - 1)
-            offset = lvalue.size - 1
-            offset_low = offset & 0b11111111
-            offset_high = offset >> 8
-            self.instructions += [
-                "ldr a l",
-                f"add {offset_low}",
-                "ldr l a",
-                "ldr a h",
-                f"add cc {offset_high}",
-                "ldr h a",
-                f"ldr c {lvalue.size}",
-                f"L{self.label_count}:",
-                "ldr a c",
-                f"jmp zf L{self.label_count + 1}",
-                "dec",
-                "ldr c a",
-                "ldr a m",
-                "psh a",
-                "ldr a l",
-                "dec",
-                "ldr l a",
-                "ldr a h",
-                "dec cc",
-                "ldr h a",
-                f"jmp L{self.label_count}",
-                f"L{self.label_count + 1}:",
-            ]
-            self.label_count += 2
-
+            self.load(lvalue)
             return lvalue
         elif ctx.CONSTANT():
             constant = int(ctx.CONSTANT(0).getText())
             width = int(ctx.CONSTANT(1).getText())
 
-            if width == 8:
-                self.instructions += [
-                    f"psh {constant}"
-                ]
-            elif width == 16:
-                constant_low = constant & 0b11111111
-                constant_high = constant >> 8
-                self.instructions += [
-                    f"psh {constant_high}",
-                    f"psh {constant_low}",
-                ]
-            else:
+            if width not in (8, 16):
                 raise CompileError("Invalid width", ctx.CONSTANT(1).start.line, ctx.CONSTANT(1).start.column)
+            self.result_constant(width // 8, constant)
 
             return BaseType(width)
         elif ctx.type_():
             type_ = self.visitType(ctx.type_())
             type_.calculate_size(self.data_table)
-
-            size = type_.size
-            size_low = size & 0b11111111
-            size_high = size >> 8
-            self.instructions += [
-                f"psh {size_high}",
-                f"psh {size_low}",
-            ]
+            self.result_constant(2, type_.size)
 
             return BaseType(16)
         elif ctx.CHARACTER():
@@ -1373,9 +2057,7 @@ class CodeGenerator(StornVisitor):
 
             if character_ascii > 127:
                 raise CompileError(f"Character '{character}' not found in 7-bit ASCII", ctx.CHARACTER().start.line, ctx.CHARACTER().start.column)
-            self.instructions += [
-                f"psh {character_ascii}",
-            ]
+            self.result_constant(1, character_ascii)
 
             return BaseType(8)
         elif ctx.STRING():
@@ -1385,8 +2067,9 @@ class CodeGenerator(StornVisitor):
                 raise CompileError(f"String '{string}' non-7-bit-ASCII characters", ctx.STRING().start.line, ctx.STRING().start.column)
 
             self.instructions += [
-                *[f"psh {character_ascii}" for character_ascii in reversed(string_ascii)]
+                *[("psh", character_ascii) for character_ascii in reversed(string_ascii)]
             ]
+            self.result_on_stack(len(string_ascii))
 
             return_type = ArrayType(BaseType(8), len(string_ascii))
             return_type.size = len(string_ascii)
@@ -1394,6 +2077,91 @@ class CodeGenerator(StornVisitor):
         else:
             raise Exception("Unknown primary expression type")
 
+    # Pops an address and loads the value of the given type there
+    def load(self, lvalue: Type):
+        address = self.pop_operand()
+
+        # Values at a constant address are loaded directly
+        if address.constant is not None and lvalue.size <= max(self.unroll_limit, 2):
+            if lvalue.size <= 2:
+                registers = self.allocate(lvalue.size)
+                self.instructions += [
+                    ("ldr", register, absolute(address.constant + i))
+                    for i, register in enumerate(reversed(registers))
+                ]
+                self.result_in(*registers)
+                return
+            for i in reversed(range(lvalue.size)):
+                self.instructions += [
+                    ("ldr", "a", absolute(address.constant + i)),
+                    ("psh", "a"),
+                ]
+            self.result_on_stack(lvalue.size)
+            return
+
+        self.address_in_hl(address)
+        # Values that fit are loaded straight into registers from [HL, HL + (size - 1)]
+        if lvalue.size == 1:
+            register, = self.allocate(1)
+            self.instructions += [
+                ("ldr", register, "m"),
+            ]
+            self.result_in(register)
+            return
+        elif lvalue.size == 2:
+            high, low = self.allocate(2, avoid=("h", "l"))
+            self.instructions += [
+                ("ldr", low, "m"),
+                *INCREMENT_HL,
+                ("ldr", high, "m"),
+            ]
+            self.result_in(high, low)
+            return
+
+        # Push bytes from memory range [HL, HL + (size - 1)] to stack
+        # Note that bytes are pushed in reverse order, starting from HL + (size - 1)
+        offset = lvalue.size - 1
+        offset_low = offset & 0b11111111
+        offset_high = offset >> 8
+        self.instructions += [
+            ("ldr", "a", "l"),
+            ("add", offset_low),
+            ("ldr", "l", "a"),
+            ("ldr", "a", "h"),
+            ("add", "cc", offset_high),
+            ("ldr", "h", "a"),
+        ]
+        if lvalue.size <= self.unroll_limit:
+            for i in range(lvalue.size):
+                self.instructions += [
+                    *(DECREMENT_HL if i > 0 else []),
+                    ("ldr", "a", "m"),
+                    ("psh", "a"),
+                ]
+            self.result_on_stack(lvalue.size)
+            return
+
+        self.instructions += [
+            ("ldr", "c", lvalue.size),
+            Label(f"L{self.label_count}"),
+            ("ldr", "a", "c"),
+            ("jmp", "zf", f"L{self.label_count + 1}"),
+            ("dec",),
+            ("ldr", "c", "a"),
+            ("ldr", "a", "m"),
+            ("psh", "a"),
+            ("ldr", "a", "l"),
+            ("dec",),
+            ("ldr", "l", "a"),
+            ("ldr", "a", "h"),
+            ("dec", "cc"),
+            ("ldr", "h", "a"),
+            ("jmp", f"L{self.label_count}"),
+            Label(f"L{self.label_count + 1}"),
+        ]
+        self.label_count += 2
+        self.result_on_stack(lvalue.size)
+
     def visitType(self, ctx: StornParser.TypeContext) -> Type:
         if ctx.getChildCount() == 1: # Base type
             text = ctx.getText()
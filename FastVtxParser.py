@@ -0,0 +1,46 @@
+import re
+from typing import Union
+from Assembler import Label, Line, ENCODINGS, MNEMONICS, operand_kind
+
+LABEL = re.compile(r"[a-zA-Z_][a-zA-Z0-9_]*")
+ADDRESS = re.compile(r"@[0-9]+")
+
+# Hand-written single-pass alternative to VtxLexer / VtxParser.
+# Vtx is line oriented so each line is split into whitespace-separated
+# tokens and checked against the assembler's encoding table, which
+# avoids the overhead of the ANTLR runtime.
+# Produces the lines consumed by `Assembler.assemble`
+class FastVtxParser:
+    def __init__(self, source: str):
+        self.source = source
+
+    def program(self) -> list[Line]:
+        lines: list[Line] = []
+        for line_number, text in enumerate(self.source.splitlines(), 1):
+            # Comments run from ' to the end of the line
+            text = text.partition("'")[0]
+            while ":" in text:
+                name, _, text = text.partition(":")
+                name = name.strip()
+                if not LABEL.fullmatch(name) or name in MNEMONICS:
+                    raise Exception(f"{line_number}:0 Invalid label '{name}'")
+                lines.append(Label(name))
+            tokens = text.split()
+            if tokens:
+                lines.append(self.instruction(tokens, line_number))
+        return lines
+
+    def instruction(self, tokens: list[str], line_number: int) -> tuple:
+        mnemonic = tokens[0]
+        operands: list[Union[int, str]] = []
+        for token in tokens[1:]:
+            if token.isdigit():
+                operands.append(int(token))
+            elif LABEL.fullmatch(token) or ADDRESS.fullmatch(token):
+                operands.append(token)
+            else:
+                raise Exception(f"{line_number}:0 Invalid operand '{token}'")
+        kinds = tuple(operand_kind(operand) for operand in operands)
+        if (mnemonic, kinds) not in ENCODINGS:
+            raise Exception(f"{line_number}:0 Invalid instruction '{' '.join(tokens)}'")
+        return (mnemonic, *operands)
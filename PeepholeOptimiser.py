@@ -0,0 +1,381 @@
+import re
+from collections import Counter
+from typing import Optional
+from Assembler import Label, Line, opcode_name
+
+NEGATED_CONDITIONS = {"zf": "nzf", "nzf": "zf", "sf": "nsf", "nsf": "sf", "cf": "ncf", "ncf": "cf"}
+GENERAL_REGISTERS = {"a", "b", "c", "h", "l"}
+# Routines return their results in these (see CodeGenerator.RESULT_REGISTERS)
+RESULT_REGISTERS = {"b", "c"}
+# Labels the generator makes up, as opposed to routine names, which other
+# modules and the assembler's exports refer to
+INTERNAL_LABEL = re.compile(r"L\d+")
+# Liveness gives up and assumes a register is live after scanning this many lines
+LIVENESS_LIMIT = 64
+
+# Labels are tuples too
+def is_instruction(line: Optional[Line]) -> bool:
+    return line is not None and not isinstance(line, Label)
+
+def read(operand) -> set[str]:
+    if operand == "m":
+        return {"h", "l"}
+    if operand == "s":
+        return {"z", "carry"}
+    if isinstance(operand, str) and not operand.startswith("@"):
+        return {operand}
+    return set()
+
+def written(operand) -> set[str]:
+    if operand == "a":
+        return {"a", "z"}
+    if operand == "s":
+        return {"z", "carry"}
+    return {operand}
+
+# Registers an instruction reads and writes. "z" stands for the zero and sign
+# flags, which are set on every write to A, and "carry" for the carry flag,
+# which only ALU operations set
+def effects(line: tuple) -> tuple[set[str], set[str]]:
+    match line:
+        case ("psh", source):
+            return read(source), set()
+        case ("pop", destination):
+            return set(), written(destination)
+        case ("ldr", destination, source):
+            return read(source), written(destination)
+        case ("str", destination, source):
+            return read(destination) | read(source), set()
+        case ("add" | "sub", "cc", source):
+            return {"a", "carry"} | read(source), {"a", "z", "carry"}
+        case ("add" | "sub", source):
+            return {"a"} | read(source), {"a", "z", "carry"}
+        case ("and" | "or" | "xor", source):
+            return {"a"} | read(source), {"a", "z"}
+        case ("inc" | "dec" | "shl" | "shr", "cc"):
+            return {"a", "carry"}, {"a", "z", "carry"}
+        case ("inc" | "dec" | "shl" | "shr",):
+            return {"a"}, {"a", "z", "carry"}
+        case ("jmp", "cf" | "ncf", target):
+            return {"carry"} | ({"h", "l"} if target == "m" else set()), set()
+        case ("jmp", _, target):
+            return {"z"} | ({"h", "l"} if target == "m" else set()), set()
+        case ("jmp", "m"):
+            return {"h", "l"}, set()
+        case ("out",):
+            return {"a"}, set()
+        case ("cal", _):
+            return set(), {"a", "z"} # the call loads its target through A
+    return set(), set()
+
+# Rule-driven peephole pass over the generator's instructions. Each rule looks
+# at the lines from a position and either returns how many lines it replaces
+# and with what, or None. Rules are applied until none match, counting hits
+# per rule in `stats`
+class PeepholeOptimiser:
+    def __init__(self, stats: Optional[Counter] = None):
+        self.stats = stats if stats is not None else Counter()
+        self.rules = [
+            self.push_pop,
+            self.push_around,
+            self.load_back,
+            self.jump_to_next,
+            self.thread_jump,
+            self.merge_labels,
+            self.unused_label,
+            self.unreachable,
+            self.materialised_condition,
+            self.zero_offset,
+            self.dead_load,
+        ]
+        self.lines: list[Line] = []
+        self.label_positions: dict[str, int] = {}
+        self.label_references: Counter = Counter()
+        self.indexed = False
+
+    # Passes are repeated until one changes nothing, since a jump can only
+    # be threaded once the code at its target has been simplified. The
+    # number of jumps removed overall is counted as `jumps_removed`
+    def optimise(self, lines: list[Line]) -> list[Line]:
+        self.lines = list(lines)
+        self.indexed = False
+        jumps = self.jump_count()
+        while self.optimise_pass():
+            pass
+        self.stats["jumps_removed"] += jumps - self.jump_count()
+        return self.lines
+
+    def jump_count(self) -> int:
+        return sum(1 for line in self.lines if is_instruction(line) and line[0] == "jmp")
+
+    # Returns whether any rule applied
+    def optimise_pass(self) -> bool:
+        changed = False
+        i = 0
+        while i < len(self.lines):
+            for rule in self.rules:
+                replacement = rule(i)
+                if replacement is not None:
+                    length, new_lines = replacement
+                    self.lines[i:i + length] = new_lines
+                    self.stats[rule.__name__] += 1
+                    self.indexed = False
+                    changed = True
+                    # A replacement can complete a pattern that starts a little earlier
+                    i = max(i - 3, 0)
+                    break
+            else:
+                i += 1
+        return changed
+
+    def index(self):
+        if self.indexed:
+            return
+        self.label_positions = {}
+        self.label_references = Counter()
+        for i, line in enumerate(self.lines):
+            if isinstance(line, Label):
+                self.label_positions[line.name] = i
+            elif line[0] in ("jmp", "cal") and isinstance(line[-1], str) and line[-1] != "m" and not line[-1].startswith("@"):
+                self.label_references[line[-1]] += 1
+        self.indexed = True
+
+    def line(self, i: int) -> Optional[Line]:
+        return self.lines[i] if 0 <= i < len(self.lines) else None
+
+    # Whether `register` is written before it is read on every path from
+    # position i. Anything else that can't be followed counts as a read
+    def is_dead(self, i: int, register: str) -> bool:
+        self.index()
+        pending = [i]
+        visited = set()
+        steps = 0
+        while pending:
+            i = pending.pop()
+            while True:
+                if i in visited:
+                    break
+                visited.add(i)
+                steps += 1
+                if i >= len(self.lines) or steps > LIVENESS_LIMIT:
+                    return False
+                line = self.lines[i]
+                if isinstance(line, Label):
+                    i += 1
+                    continue
+                reads, writes = effects(line)
+                if register in reads or line == ("jmp", "m") and register in RESULT_REGISTERS:
+                    return False
+                # Registers other than the result's are dead at a return (jmp m)
+                if register in writes or line[0] in ("hlt", "irt") or line == ("jmp", "m"):
+                    break
+                if line[0] == "cal":
+                    return False
+                if line[0] == "jmp":
+                    if line[-1] == "m" or line[-1] not in self.label_positions:
+                        return False
+                    pending.append(self.label_positions[line[-1]])
+                    if len(line) == 2:
+                        break
+                i += 1
+        return True
+
+    # psh x / pop y => ldr y x
+    def push_pop(self, i: int) -> Optional[tuple[int, list[Line]]]:
+        push, pop = self.line(i), self.line(i + 1)
+        if not (is_instruction(push) and is_instruction(pop) and push[0] == "psh" and pop[0] == "pop"):
+            return None
+        return self.move(pop[1], push[1], 2, [])
+
+    # psh x / i / pop y => i / ldr y x, where i leaves x and the stack alone
+    def push_around(self, i: int) -> Optional[tuple[int, list[Line]]]:
+        push, middle, pop = self.line(i), self.line(i + 1), self.line(i + 2)
+        if not (is_instruction(push) and is_instruction(middle) and is_instruction(pop)):
+            return None
+        if push[0] != "psh" or pop[0] != "pop" or middle[0] in ("psh", "pop", "cal", "jmp", "hlt", "irt"):
+            return None
+        reads, writes = effects(middle)
+        if (reads | writes) & {"spl", "sph"} or read(push[1]) & writes:
+            return None
+        return self.move(pop[1], push[1], 3, [middle])
+
+    def move(self, destination, source, length: int, before: list[Line]) -> Optional[tuple[int, list[Line]]]:
+        if "s" in (destination, source) or isinstance(source, str) and source.startswith("@"):
+            return None
+        if destination == source:
+            return length, before
+        if opcode_name(("ldr", destination, source)) is None:
+            return None
+        return length, before + [("ldr", destination, source)]
+
+    # ldr x y / ldr y x => ldr x y
+    def load_back(self, i: int) -> Optional[tuple[int, list[Line]]]:
+        first, second = self.line(i), self.line(i + 1)
+        if not (is_instruction(first) and is_instruction(second) and first[0] == second[0] == "ldr"):
+            return None
+        if first[1] == second[2] and first[2] == second[1] and first[2] in GENERAL_REGISTERS | {"bpl", "bph", "spl", "sph"}:
+            return 2, [first]
+        return None
+
+    # jmp l / ... l: jmp l' => jmp l', following the chain to its end
+    def thread_jump(self, i: int) -> Optional[tuple[int, list[Line]]]:
+        jump = self.line(i)
+        if not (is_instruction(jump) and jump[0] == "jmp" and jump[-1] != "m"):
+            return None
+        self.index()
+        target = jump[-1]
+        seen = {target}
+        while target in self.label_positions:
+            j = self.label_positions[target]
+            while isinstance(self.line(j), Label):
+                j += 1
+            next_jump = self.line(j)
+            if not (is_instruction(next_jump) and next_jump[0] == "jmp" and len(next_jump) == 2) or next_jump[1] in seen:
+                break
+            target = next_jump[1]
+            seen.add(target)
+        threaded = (*jump[:-1], target)
+        if target == jump[-1] or opcode_name(threaded) is None:
+            return None
+        return 1, [threaded]
+
+    # l: / l': => l:, referring to l' as l. Routine labels are kept
+    def merge_labels(self, i: int) -> Optional[tuple[int, list[Line]]]:
+        first, second = self.line(i), self.line(i + 1)
+        if not (isinstance(first, Label) and isinstance(second, Label)):
+            return None
+        if INTERNAL_LABEL.fullmatch(second.name):
+            kept, merged = first, second
+        elif INTERNAL_LABEL.fullmatch(first.name):
+            kept, merged = second, first
+        else:
+            return None
+        for j, line in enumerate(self.lines):
+            if is_instruction(line) and line[0] in ("jmp", "cal") and line[-1] == merged.name:
+                self.lines[j] = (*line[:-1], kept.name)
+        return 2, [kept]
+
+    # A label nothing else jumps to, which would stop unreachable lines after
+    # it being removed. Jumps from its own block only count if the block can
+    # be fallen into, eg. `jmp l / l: jmp l` is never run
+    def unused_label(self, i: int) -> Optional[tuple[int, list[Line]]]:
+        label = self.line(i)
+        if not (isinstance(label, Label) and INTERNAL_LABEL.fullmatch(label.name)):
+            return None
+        self.index()
+        references = self.label_references[label.name]
+        if references == 0:
+            return 1, []
+        previous = self.line(i - 1)
+        if not (is_instruction(previous) and (previous[0] == "jmp" and len(previous) == 2 or previous[0] in ("hlt", "irt"))):
+            return None
+        j = i + 1
+        while is_instruction(self.line(j)):
+            if self.lines[j][0] in ("jmp", "cal") and self.lines[j][-1] == label.name:
+                references -= 1
+            j += 1
+        return (1, []) if references == 0 else None
+
+    # jmp l / l: => l:
+    def jump_to_next(self, i: int) -> Optional[tuple[int, list[Line]]]:
+        jump = self.line(i)
+        if not (is_instruction(jump) and jump[0] == "jmp" and jump[-1] != "m"):
+            return None
+        j = i + 1
+        while isinstance(self.line(j), Label):
+            if self.lines[j].name == jump[-1]:
+                return 1, []
+            j += 1
+        return None
+
+    # Lines between an unconditional transfer and the next label never run
+    def unreachable(self, i: int) -> Optional[tuple[int, list[Line]]]:
+        transfer = self.line(i)
+        if not (is_instruction(transfer) and (transfer[0] == "jmp" and len(transfer) == 2 or transfer[0] in ("hlt", "irt"))):
+            return None
+        j = i + 1
+        while j < len(self.lines) and not isinstance(self.lines[j], Label):
+            j += 1
+        if j == i + 1:
+            return None
+        return j - i, [transfer]
+
+    # Comparisons materialise their result as 0 or 1 in registers, which a
+    # condition then tests. Branch on the comparison's flag instead:
+    #   jmp <flag> true        (false labels:)
+    #   ldr r 0 ...            ldr r 0 ...
+    #   jmp done               jmp done
+    #   true:                  true:
+    #   ldr r 0 ... ldr r' 1   ldr r 0 ... ldr r' 1
+    #   done:                  done:
+    #   ldr a r (or ldr a r / or r')
+    #   jmp zf|nzf target
+    def materialised_condition(self, i: int) -> Optional[tuple[int, list[Line]]]:
+        branch = self.line(i)
+        if not (is_instruction(branch) and branch[0] == "jmp" and len(branch) == 3 and branch[1] in NEGATED_CONDITIONS):
+            return None
+        condition, true_label = branch[1], branch[2]
+        j = i + 1
+        false_labels = []
+        while isinstance(self.line(j), Label):
+            false_labels.append(self.lines[j])
+            j += 1
+        registers = []
+        while is_instruction(load := self.line(j)) and load[0] == "ldr" and load[1] in GENERAL_REGISTERS - {"a"} and load[2] == 0:
+            registers.append(load[1])
+            j += 1
+        if len(registers) not in (1, 2):
+            return None
+        done = self.line(j)
+        if not (is_instruction(done) and done[0] == "jmp" and len(done) == 2):
+            return None
+        done_label = done[1]
+        expected = [Label(true_label), *[("ldr", register, 0) for register in registers[:-1]], ("ldr", registers[-1], 1), Label(done_label)]
+        expected += [("ldr", "a", registers[0]), *[("or", register) for register in registers[1:]]]
+        if self.lines[j + 1:j + 1 + len(expected)] != expected:
+            return None
+        j += 1 + len(expected)
+        test = self.line(j)
+        if not (is_instruction(test) and test[0] == "jmp" and len(test) == 3 and test[1] in ("zf", "nzf")):
+            return None
+        target = test[2]
+        end = j + 1
+
+        self.index()
+        if self.label_references[true_label] != 1 or self.label_references[done_label] != 1 or target not in self.label_positions:
+            return None
+        for register in ["a", "z", *registers]:
+            if not (self.is_dead(end, register) and self.is_dead(self.label_positions[target], register)):
+                return None
+
+        if test[1] == "nzf": # jump when the comparison holds
+            return end - i, [("jmp", condition, target), *false_labels]
+        if not false_labels:
+            return end - i, [("jmp", NEGATED_CONDITIONS[condition], target)]
+        return end - i, [branch, *false_labels, ("jmp", target), Label(true_label)]
+
+    # Adding a zero offset to a register pair:
+    #   ldr a l / add 0 / ldr l a / ldr a h / add cc 0 / ldr h a
+    def zero_offset(self, i: int) -> Optional[tuple[int, list[Line]]]:
+        window = self.lines[i:i + 6]
+        if len(window) != 6 or not all(is_instruction(line) for line in window):
+            return None
+        match window:
+            case [("ldr", "a", low), ("add" | "sub" as operation, 0), ("ldr", low_, "a"), ("ldr", "a", high), (operation_, "cc", 0), ("ldr", high_, "a")]:
+                if low != low_ or high != high_ or operation != operation_:
+                    return None
+            case _:
+                return None
+        if all(self.is_dead(i + 6, register) for register in ("a", "z", "carry")):
+            return 6, []
+        return None
+
+    # ldr x y where x is overwritten before it's read
+    def dead_load(self, i: int) -> Optional[tuple[int, list[Line]]]:
+        load = self.line(i)
+        if not (is_instruction(load) and load[0] == "ldr" and load[1] in GENERAL_REGISTERS):
+            return None
+        _, writes = effects(load)
+        if all(self.is_dead(i + 1, register) for register in writes):
+            return 1, []
+        return None
@@ -0,0 +1,38 @@
+import os
+from typing import Dict, Iterable, List
+from Assembler import Label, Line
+from FastVtxParser import FastVtxParser
+
+RUNTIME_FILENAME = "runtime.vtx"
+# Entry labels of each routine in the runtime library, in the order they're
+# linked. A routine's code starts at its first entry label
+ROUTINES = {
+    "mul8": ["__mul8"],
+    "mul16": ["__mul16"],
+    "divmod8": ["__divmod8"],
+    "divmod16": ["__div16", "__mod16"],
+}
+
+routine_lines: Dict[str, List[Line]] = {}
+
+# Splits the library into its routines the first time it's needed
+def load() -> Dict[str, List[Line]]:
+    if routine_lines:
+        return routine_lines
+    directory = os.path.dirname(os.path.abspath(__file__))
+    with open(os.path.join(directory, RUNTIME_FILENAME), "r") as runtime_file:
+        lines = FastVtxParser(runtime_file.read()).program()
+    starts = {entries[0]: name for name, entries in ROUTINES.items()}
+    name = None
+    for line in lines:
+        if isinstance(line, Label) and line.name in starts:
+            name = starts[line.name]
+            routine_lines[name] = []
+        routine_lines[name].append(line)
+    return routine_lines
+
+# The code of the given routines, to be placed after a module's own
+def link(names: Iterable[str]) -> List[Line]:
+    routines = load()
+    names = set(names)
+    return [line for name in ROUTINES if name in names for line in routines[name]]
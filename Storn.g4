@@ -171,7 +171,13 @@ shiftOp
         ;
 
 multiplicativeExpr
-        : unaryExpr ('*' unaryExpr)*
+        : unaryExpr (multiplicativeOp unaryExpr)*
+        ;
+
+multiplicativeOp
+        : TIMES
+        | DIVIDE
+        | MODULO
         ;
 
 unaryExpr
@@ -179,10 +185,11 @@ unaryExpr
         | primaryExpr
         ;
 
+// Lvalues come first so `(x) / y` is still a projection rather than a division
 primaryExpr
-        : '(' expression ')'
+        : lvalue
+        | '(' expression ')'
         | call
-        | lvalue
         | CONSTANT ':' CONSTANT
         | '#' type
         | STRING
@@ -290,6 +297,19 @@ NOT
         : '~'
         ;
 
+TIMES
+        : '*'
+        ;
+
+// Also separates projected field names in lvalues
+DIVIDE
+        : '/'
+        ;
+
+MODULO
+        : '%'
+        ;
+
 SHR
         : '>>'
         ;
@@ -0,0 +1,83 @@
+import json
+import hashlib
+from collections.abc import Mapping
+from typing import Union
+import yaml
+
+MAGIC = "#storn-symbols 1\n"
+EXTENSION = ".sym"
+SECTIONS = ["globals", "data", "routines"]
+
+# A symbol table file is the magic line, then a JSON index line mapping each
+# section's names to the (offset, length) of their entry, then one JSON line
+# per entry. Offsets are relative to the end of the index line. Importers
+# typically use a handful of a library's symbols, so entries are only
+# decoded when they're looked up
+class SymbolSection(Mapping):
+    def __init__(self, body: str, index: dict[str, list[int]]):
+        self.body = body
+        self.index = index
+        self.decoded = {}
+
+    def __getitem__(self, name: str) -> dict:
+        if name not in self.decoded:
+            offset, length = self.index[name]
+            self.decoded[name] = json.loads(self.body[offset:offset + length])
+        return self.decoded[name]
+
+    def __contains__(self, name: object) -> bool:
+        return name in self.index
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+class SymbolTable(Mapping):
+    def __init__(self, text: str):
+        index_end = text.index("\n", len(MAGIC)) + 1
+        index = json.loads(text[len(MAGIC):index_end])
+        body = text[index_end:]
+        self.sections = {section: SymbolSection(body, index[section]) for section in SECTIONS}
+        # Stands in for the contents when hashing, eg. for cache keys
+        self.digest = hashlib.sha256(text.encode()).hexdigest()
+
+    def __getitem__(self, section: str) -> SymbolSection:
+        return self.sections[section]
+
+    def __iter__(self):
+        return iter(self.sections)
+
+    def __len__(self) -> int:
+        return len(self.sections)
+
+def dumps(exports: dict) -> str:
+    index = {section: {} for section in SECTIONS}
+    entries = []
+    offset = 0
+    for section in SECTIONS:
+        for name, entry in exports[section].items():
+            line = json.dumps(entry, separators=(",", ":")) + "\n"
+            index[section][name] = [offset, len(line)]
+            entries.append(line)
+            offset += len(line)
+    return MAGIC + json.dumps(index, separators=(",", ":")) + "\n" + "".join(entries)
+
+# YAML remains supported; the format is detected from the contents
+def loads(text: str) -> Union[dict, SymbolTable]:
+    if text.startswith(MAGIC):
+        return SymbolTable(text)
+    return yaml.safe_load(text)
+
+def load(path: str) -> Union[dict, SymbolTable]:
+    with open(path, "r") as symbol_file:
+        return loads(symbol_file.read())
+
+# Paths ending in .sym are written as symbol tables, anything else as YAML
+def dump(exports: dict, path: str):
+    with open(path, "w") as symbol_file:
+        if path.endswith(EXTENSION):
+            symbol_file.write(dumps(exports))
+        else:
+            yaml.dump(exports, symbol_file)
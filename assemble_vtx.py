@@ -4,18 +4,25 @@ from antlr4 import FileStream, InputStream, CommonTokenStream
 from vtx.VtxLexer import VtxLexer
 from vtx.VtxParser import VtxParser
 from Assembler import Assembler
+from FastVtxParser import FastVtxParser
 
-def assemble(source, is_file, start_address):
+def assemble(source, is_file, start_address, parser_name="antlr"):
     imports = {"globals": {}, "data": {}, "routines": {}}
     exports = {"globals": {}, "data": {}, "routines": {}}
 
-    input = FileStream(source) if is_file else InputStream(source)
-    lexer = VtxLexer(input)
-    stream = CommonTokenStream(lexer)
-    parser = VtxParser(stream)
-    tree = parser.program()
     assembler = Assembler(imports, exports, start_address)
-    assembler.visit(tree)
+    if parser_name == "fast":
+        if is_file:
+            with open(source, "r") as source_file:
+                source = source_file.read()
+        assembler.assemble(FastVtxParser(source).program())
+    else:
+        input = FileStream(source) if is_file else InputStream(source)
+        lexer = VtxLexer(input)
+        stream = CommonTokenStream(lexer)
+        parser = VtxParser(stream)
+        tree = parser.program()
+        assembler.visit(tree)
     return bytearray(assembler.instructions)
 
 def main():
@@ -23,13 +30,14 @@ def main():
     parser.add_argument("input", nargs="?", help="Source file (or stdin if omitted)")
     parser.add_argument("-o", "--output", help="Output file (or stdout if omitted)")
     parser.add_argument("-a", "--address", type=lambda x: int(x, 0), help="Address in memory to start program from. Used for label address resolution. Default (omission) places program at the end of memory")
+    parser.add_argument("-p", "--parser", choices=["antlr", "fast"], default="antlr", help="Assembly parser. 'fast' is a hand-written alternative to the ANTLR parser")
     args = parser.parse_args()
 
     if args.input:
-        program = assemble(args.input, True, args.address)
+        program = assemble(args.input, True, args.address, args.parser)
     else:
         source = sys.stdin.read()
-        program = assemble(source, False, args.address)
+        program = assemble(source, False, args.address, args.parser)
     if args.output:
         with open(args.output, "wb") as rom_file:
             rom_file.write(program)
@@ -0,0 +1,57 @@
+import os
+import shlex
+import argparse
+import tempfile
+
+from benchmarks.cycles import measure
+
+# Each runtime routine by an operation calling it, and operand pairs to time
+# it with: small operands, then the largest
+ROUTINES = [
+    ("mul8", "*", 8, [(200, 7), (255, 255)]),
+    ("mul16", "*", 16, [(40000, 7), (40000, 300), (65535, 65535)]),
+    ("divmod8", "/", 8, [(200, 7), (255, 1)]),
+    ("divmod16", "/", 16, [(40000, 7), (40000, 300), (65535, 1)]),
+]
+
+def program(operation: str, width: int, x: int, y: int, repeat: int) -> str:
+    result_width = 16 if operation == "*" else width
+    statements = f"        r = x {operation} (y).\n" * repeat
+    return (
+        "routine entry () -> [0]\n"
+        f"        x: [{width}].\n"
+        f"        y: [{width}].\n"
+        f"        r: [{result_width}].\n"
+        "{\n"
+        f"        x = {x}:{width}.\n"
+        f"        y = {y}:{width}.\n"
+        f"{statements}"
+        "        return.\n"
+        "}\n"
+    )
+
+def main():
+    parser = argparse.ArgumentParser(description="VM cycles per call of each runtime arithmetic routine, including loading its operands and storing the result")
+    parser.add_argument("-r", "--repeat", type=int, default=16, help="Operations per program; the cost is the difference from a program without them")
+    parser.add_argument("-f", "--flags", default="", help="Compiler flags (default none)")
+    parser.add_argument("-t", "--timeout", type=float, default=2, help="Seconds before a program is treated as not halting")
+    args = parser.parse_args()
+    directory = tempfile.mkdtemp()
+    source_path = os.path.join(directory, "arithmetic.stn")
+    rom_path = os.path.join(directory, "program")
+
+    print(f"{'routine':<10} {'x':>6} {'y':>6} {'cycles':>8}")
+    for routine, operation, width, operand_pairs in ROUTINES:
+        for x, y in operand_pairs:
+            cycles = []
+            for repeat in (0, args.repeat):
+                with open(source_path, "w") as source_file:
+                    source_file.write(program(operation, width, x, y, repeat))
+                cycles.append(measure(source_path, shlex.split(args.flags), rom_path, args.timeout)[1])
+            if None in cycles:
+                print(f"{routine:<10} {x:>6} {y:>6} {'-':>8}")
+                continue
+            print(f"{routine:<10} {x:>6} {y:>6} {(cycles[1] - cycles[0]) / args.repeat:>8.1f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+import argparse
+import time
+from antlr4 import InputStream, CommonTokenStream
+from vtx.VtxLexer import VtxLexer
+from vtx.VtxParser import VtxParser
+from Assembler import Assembler
+
+# Each block is 11 bytes of ROM and contains two label references,
+# roughly the jump density of compiler output
+BLOCK = [
+    "L{n}:",
+    "ldr a c",
+    "jmp zf L{next}",
+    "dec",
+    "ldr c a",
+    "pop a",
+    "str m a",
+    "jmp L{n}",
+]
+BLOCK_SIZE = 11
+
+def synthetic_program(size: int) -> str:
+    lines = []
+    blocks = size // BLOCK_SIZE
+    for n in range(blocks):
+        lines += [line.format(n=n, next=n + 1) for line in BLOCK]
+    lines += [f"L{blocks}:", "hlt"]
+    return "\n".join(lines) + "\n"
+
+def benchmark(size: int) -> tuple[int, int, float, float]:
+    source = synthetic_program(size)
+    start = time.perf_counter()
+    parser = VtxParser(CommonTokenStream(VtxLexer(InputStream(source))))
+    tree = parser.program()
+    parsed = time.perf_counter()
+    imports = {"globals": {}, "data": {}, "routines": {}}
+    exports = {"globals": {}, "data": {}, "routines": {}}
+    assembler = Assembler(imports, exports, None)
+    assembler.visit(tree)
+    assembled = time.perf_counter()
+    return len(assembler.instructions), len(assembler.relocations), parsed - start, assembled - parsed
+
+def main():
+    parser = argparse.ArgumentParser(description="Assembler benchmark over synthetic programs")
+    parser.add_argument("-s", "--sizes", type=int, nargs="+", default=[2048, 4096, 8192, 16384, 30720], help="Program sizes in bytes")
+    args = parser.parse_args()
+
+    print(f"{'bytes':>8} {'labels':>8} {'parse (s)':>10} {'assemble (s)':>13}")
+    for size in args.sizes:
+        program_size, relocation_count, parse_time, assemble_time = benchmark(size)
+        print(f"{program_size:>8} {relocation_count:>8} {parse_time:>10.3f} {assemble_time:>13.3f}")
+
+if __name__ == "__main__":
+    main()
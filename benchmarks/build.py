@@ -0,0 +1,44 @@
+import os
+import re
+import glob
+import time
+import argparse
+import tempfile
+import subprocess
+import yaml
+
+def wall_time(manifest: str, jobs: int, repeats: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeats):
+        subprocess.run(["python", "build_storn.py", manifest, "-j", str(jobs)], check=True, stdout=subprocess.DEVNULL)
+    return (time.perf_counter() - start) / repeats
+
+def main():
+    parser = argparse.ArgumentParser(description="Wall time of build_storn.py building every example and test program serially and in parallel")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="Parallel jobs to compare against one")
+    parser.add_argument("-r", "--repeats", type=int, default=3, help="Builds per configuration")
+    args = parser.parse_args()
+
+    # Every standalone program is an independent module; the network
+    # peripheral adds a module that has to wait for its import
+    output_directory = tempfile.mkdtemp()
+    programs = sorted(glob.glob("examples/*.stn") + glob.glob("tests/storn/**/*.stn", recursive=True))
+    modules = {}
+    for program in programs:
+        name = re.sub(r"\W", "_", os.path.splitext(program)[0])
+        modules[name] = {"source": program, "output": os.path.join(output_directory, name)}
+    with open("peripherals/network.yaml", "r") as network_file:
+        for name, module in yaml.safe_load(network_file)["modules"].items():
+            modules[name] = dict(module, output=os.path.join(output_directory, name))
+    manifest = os.path.join(output_directory, "manifest.yaml")
+    with open(manifest, "w") as manifest_file:
+        yaml.dump({"modules": modules}, manifest_file)
+
+    serial = wall_time(manifest, 1, args.repeats)
+    parallel = wall_time(manifest, args.jobs, args.repeats)
+    print(f"{len(modules)} modules")
+    print(f"{'serial (s)':>10} {f'{args.jobs} jobs (s)':>12} {'speedup':>8}")
+    print(f"{serial:>10.2f} {parallel:>12.2f} {serial / parallel:>7.2f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+import os
+import shlex
+import argparse
+import tempfile
+
+from benchmarks.cycles import measure
+
+# Routines of each shape of frame: parameters, locals and return width, with
+# a body that does as little as possible besides return
+SIGNATURES = [
+    ("procedure", [], [], 0),
+    ("result", [], [], 8),
+    ("parameter", [8], [], 8),
+    ("parameters", [16, 16], [], 16),
+    ("local", [8], [8], 8),
+    ("locals", [16, 16], [16, 16], 16),
+]
+
+def program(parameters: list[int], locals_: list[int], width: int, repeat: int) -> str:
+    declarations = "".join(f"        l{i}: [{size}].\n" for i, size in enumerate(locals_))
+    arguments = ", ".join(f"{i}:{size}" for i, size in enumerate(parameters))
+    call = f"!callee({arguments})"
+    statements = (f"        r = {call}.\n" if width else f"        {call}.\n") * repeat
+    return (
+        "routine callee ("
+        + ", ".join(f"p{i}: [{size}]" for i, size in enumerate(parameters))
+        + f") -> [{width}]\n"
+        f"{declarations}"
+        "{\n"
+        + (f"        return 0:{width}.\n" if width else "        return.\n")
+        + "}\n"
+        "\n"
+        "routine entry () -> [0]\n"
+        f"        r: [{width or 8}].\n"
+        "{\n"
+        f"{statements}"
+        "        return.\n"
+        "}\n"
+    )
+
+def main():
+    parser = argparse.ArgumentParser(description="VM cycles per call of routines with each shape of frame, including passing arguments and storing the result")
+    parser.add_argument("-r", "--repeat", type=int, default=16, help="Calls per program; the cost is the difference from a program without them")
+    parser.add_argument("-f", "--flags", default="--inline-limit 0", help="Compiler flags (default --inline-limit 0, so calls aren't inlined)")
+    parser.add_argument("-t", "--timeout", type=float, default=2, help="Seconds before a program is treated as not halting")
+    args = parser.parse_args()
+    directory = tempfile.mkdtemp()
+    source_path = os.path.join(directory, "calls.stn")
+    rom_path = os.path.join(directory, "program")
+
+    print(f"{'signature':<12} {'cycles':>8}")
+    for name, parameters, locals_, width in SIGNATURES:
+        cycles = []
+        for repeat in (0, args.repeat):
+            with open(source_path, "w") as source_file:
+                source_file.write(program(parameters, locals_, width, repeat))
+            cycles.append(measure(source_path, shlex.split(args.flags), rom_path, args.timeout)[1])
+        if None in cycles:
+            print(f"{name:<12} {'-':>8}")
+            continue
+        print(f"{name:<12} {(cycles[1] - cycles[0]) / args.repeat:>8.1f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,36 @@
+import os
+import glob
+import time
+import argparse
+import tempfile
+import subprocess
+
+def latency(command: list[str], repeats: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeats):
+        subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+    return (time.perf_counter() - start) / repeats
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-compile latency of cold compile_storn.py runs against a warm compile_server.py")
+    parser.add_argument("inputs", nargs="*", help="Storn programs (examples/*.stn if omitted)")
+    parser.add_argument("-r", "--repeats", type=int, default=5, help="Compiles per program")
+    args = parser.parse_args()
+    programs = args.inputs or sorted(glob.glob("examples/*.stn"))
+
+    socket_path = os.path.join(tempfile.mkdtemp(), "compile.sock")
+    server = subprocess.Popen(["python", "compile_server.py", "-S", socket_path], stderr=subprocess.DEVNULL)
+    try:
+        while not os.path.exists(socket_path):
+            time.sleep(0.05)
+        print(f"{'program':<28} {'cold (ms)':>10} {'server (ms)':>12} {'speedup':>8}")
+        for program in programs:
+            cold = latency(["python", "compile_storn.py", program, "-o", os.devnull], args.repeats)
+            warm = latency(["python", "compile_client.py", program, "-o", os.devnull, "-S", socket_path], args.repeats)
+            print(f"{program:<28} {cold * 1000:>10.0f} {warm * 1000:>12.0f} {cold / warm:>7.1f}x")
+    finally:
+        server.terminate()
+        server.wait()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+import os
+import re
+import glob
+import shlex
+import argparse
+import tempfile
+import subprocess
+
+RAM_SHM_FILENAME = "/tmp/vtx_ram_shm"
+
+def measure(program: str, flags: list[str], rom_path: str, timeout: float) -> tuple[int, int | None]:
+    subprocess.run(["python", "compile_storn.py", program, "-o", rom_path, *flags], check=True)
+    if os.path.exists(RAM_SHM_FILENAME):
+        os.remove(RAM_SHM_FILENAME)
+    try:
+        result = subprocess.run(["./out/vertex", "roms/control", rom_path], capture_output=True, text=True, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        return os.path.getsize(rom_path), None # doesn't halt, eg. display.stn
+    cycles = re.search(r"Cycles: (\d+)", result.stderr)
+    return os.path.getsize(rom_path), int(cycles.group(1)) if cycles else None
+
+def reduction(before: int, after: int) -> str:
+    return f"{100 * (before - after) / before:>6.1f}%" if before else f"{'-':>7}"
+
+def main():
+    parser = argparse.ArgumentParser(description="ROM size and VM cycle counts of every example and test program, compiled with and without a set of flags")
+    parser.add_argument("inputs", nargs="*", help="Storn programs (examples/ and tests/storn/ if omitted)")
+    parser.add_argument("-b", "--baseline", default="", help="Compiler flags for the baseline (default none)")
+    parser.add_argument("-f", "--flags", default="-O", help="Compiler flags to compare against the baseline (default -O)")
+    parser.add_argument("-t", "--timeout", type=float, default=2, help="Seconds before a program is treated as not halting")
+    args = parser.parse_args()
+    programs = args.inputs or sorted(glob.glob("examples/*.stn") + glob.glob("tests/storn/**/*.stn", recursive=True))
+    rom_path = os.path.join(tempfile.mkdtemp(), "program")
+
+    print(f"{'program':<32} {'size':>6} {'->':>6} {'saved':>7} {'cycles':>8} {'->':>8} {'saved':>7}")
+    totals = [0, 0, 0, 0]
+    for program in programs:
+        size, cycles = measure(program, shlex.split(args.baseline), rom_path, args.timeout)
+        new_size, new_cycles = measure(program, shlex.split(args.flags), rom_path, args.timeout)
+        totals[0] += size
+        totals[1] += new_size
+        if cycles is None or new_cycles is None:
+            print(f"{program:<32} {size:>6} {new_size:>6} {reduction(size, new_size)} {'-':>8} {'-':>8} {'-':>7}")
+            continue
+        totals[2] += cycles
+        totals[3] += new_cycles
+        print(f"{program:<32} {size:>6} {new_size:>6} {reduction(size, new_size)} {cycles:>8} {new_cycles:>8} {reduction(cycles, new_cycles)}")
+    print(f"{'total':<32} {totals[0]:>6} {totals[1]:>6} {reduction(totals[0], totals[1])} {totals[2]:>8} {totals[3]:>8} {reduction(totals[2], totals[3])}")
+
+if __name__ == "__main__":
+    main()
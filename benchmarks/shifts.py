@@ -0,0 +1,43 @@
+import os
+import re
+import glob
+import shlex
+import argparse
+import tempfile
+
+from benchmarks.cycles import measure, reduction
+
+# Adding a global (zero in freshly cleared RAM) hides each count from the
+# compiler, so the variant shifts in a loop
+COUNT_GLOBAL = "shift_count"
+
+def looped(source: str) -> str:
+    source = re.sub(r"(<<|>>)\s*(\d+):8", rf"\1 ({COUNT_GLOBAL} + \2:8)", source)
+    return f"global {COUNT_GLOBAL}: [8].\n{source}"
+
+def main():
+    parser = argparse.ArgumentParser(description="VM cycles of the shift test programs with constant shift counts against the same counts known only at runtime")
+    parser.add_argument("inputs", nargs="*", help="Storn programs (tests/storn/*/shift.stn if omitted)")
+    parser.add_argument("-f", "--flags", default="", help="Compiler flags for both variants (default none)")
+    parser.add_argument("-t", "--timeout", type=float, default=2, help="Seconds before a program is treated as not halting")
+    args = parser.parse_args()
+    programs = args.inputs or sorted(glob.glob("tests/storn/*/shift.stn"))
+    directory = tempfile.mkdtemp()
+    rom_path = os.path.join(directory, "program")
+
+    print(f"{'program':<32} {'looped':>8} {'constant':>8} {'saved':>7}")
+    for program in programs:
+        with open(program, "r") as source_file:
+            source = source_file.read()
+        looped_path = os.path.join(directory, "looped.stn")
+        with open(looped_path, "w") as looped_file:
+            looped_file.write(looped(source))
+        _, looped_cycles = measure(looped_path, shlex.split(args.flags), rom_path, args.timeout)
+        _, cycles = measure(program, shlex.split(args.flags), rom_path, args.timeout)
+        if looped_cycles is None or cycles is None:
+            print(f"{program:<32} {'-':>8} {'-':>8} {'-':>7}")
+            continue
+        print(f"{program:<32} {looped_cycles:>8} {cycles:>8} {reduction(looped_cycles, cycles)}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+import os
+import time
+import argparse
+import tempfile
+
+import SymbolTable
+from compile_storn import compile
+
+def library(size: int) -> dict:
+    _, _, exports = compile("peripherals/network_main.stn", True, None, {"globals": {}, "data": {}, "routines": {}}, True, False)
+    routine = exports["routines"]["output_packet"]
+    point = {"DataType": {"name": "point", "fields": {"x": {"BaseType": {"width": 16}}, "y": {"BaseType": {"width": 16}}}}}
+    exports["data"]["point"] = point
+    for i in range(size):
+        exports["routines"][f"routine_{i}"] = dict(routine, parameters={f"parameter_{j}": {"type_": {"ArrayType": {"type_": point, "length": 4}}} for j in range(4)})
+        exports["globals"][f"global_{i}"] = {"type_": {"ReferenceType": {"type_": point}}, "offset": 4 * i}
+    return exports
+
+def import_time(path: str, source: str, repeats: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeats):
+        compile(source, False, 0x410, SymbolTable.load(path), False, False)
+    return (time.perf_counter() - start) / repeats
+
+def main():
+    parser = argparse.ArgumentParser(description="Time to load a large library's exports and compile a module importing one routine from it, YAML against a symbol table")
+    parser.add_argument("-r", "--repeats", type=int, default=5, help="Compiles per format")
+    args = parser.parse_args()
+    with open("peripherals/network_handler.stn", "r") as source_file:
+        source = source_file.read()
+    directory = tempfile.mkdtemp()
+
+    print(f"{'routines':>8} {'YAML (ms)':>10} {'symbols (ms)':>13} {'speedup':>8}")
+    for size in [10, 100, 1000, 5000]:
+        exports = library(size)
+        paths = [os.path.join(directory, f"library{extension}") for extension in [".yaml", SymbolTable.EXTENSION]]
+        for path in paths:
+            SymbolTable.dump(exports, path)
+        yaml_time, symbols_time = (import_time(path, source, args.repeats) for path in paths)
+        print(f"{size:>8} {yaml_time * 1000:>10.1f} {symbols_time * 1000:>13.1f} {yaml_time / symbols_time:>7.1f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+import argparse
+import time
+from antlr4 import InputStream, CommonTokenStream
+from vtx.VtxLexer import VtxLexer
+from vtx.VtxParser import VtxParser
+from FastVtxParser import FastVtxParser
+from benchmarks.assembler import synthetic_program
+
+def parse_antlr(source: str):
+    VtxParser(CommonTokenStream(VtxLexer(InputStream(source)))).program()
+
+def parse_fast(source: str):
+    FastVtxParser(source).program()
+
+def lines_per_second(parse, source: str, repeats: int) -> float:
+    line_count = source.count("\n")
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        parse(source)
+        best = min(best, time.perf_counter() - start)
+    return line_count / best
+
+def main():
+    parser = argparse.ArgumentParser(description="Vtx parser throughput benchmark")
+    parser.add_argument("inputs", nargs="*", help="Assembly files to parse (a synthetic 30 KB program if omitted)")
+    parser.add_argument("-r", "--repeats", type=int, default=3, help="Runs per parser; the best is reported")
+    args = parser.parse_args()
+
+    sources = {}
+    for path in args.inputs:
+        with open(path, "r") as source_file:
+            sources[path] = source_file.read()
+    if not sources:
+        sources["synthetic (30 KB)"] = synthetic_program(30720)
+
+    print(f"{'program':<30} {'lines':>7} {'antlr (lines/s)':>16} {'fast (lines/s)':>15} {'speedup':>8}")
+    for name, source in sources.items():
+        antlr = lines_per_second(parse_antlr, source, args.repeats)
+        fast = lines_per_second(parse_fast, source, args.repeats)
+        print(f"{name:<30} {source.count(chr(10)):>7} {antlr:>16.0f} {fast:>15.0f} {fast / antlr:>7.1f}x")
+
+if __name__ == "__main__":
+    main()
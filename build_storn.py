@@ -0,0 +1,184 @@
+import os
+import sys
+import time
+import argparse
+import yaml
+
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from antlr4 import InputStream, Token
+
+from storn.StornLexer import StornLexer
+from CodeGenerator import CompileError
+from compile_storn import cached_compile, print_size_report
+import SymbolTable
+from BuildCache import BuildCache, DEFAULT_MAX_SIZE
+
+KINDS = {"data": "data", "global": "globals", "routine": "routines"}
+
+# A manifest maps module names to how they're built:
+#   modules:
+#     network_handler:
+#       source: peripherals/network_handler.stn
+#       output: roms/network_handler
+#       address: 0x410      # optional, as `compile_storn.py -a`
+#       assembly: ...       # optional, as `compile_storn.py -s`
+#       export: ...         # optional, as `compile_storn.py -e` (.sym for a symbol table)
+#       main: false         # optional, defaults to whether the module has no imports
+# Paths are relative to the working directory
+class Module:
+    def __init__(self, name: str, manifest: dict):
+        self.name = name
+        if "source" not in manifest or "output" not in manifest:
+            raise CompileError(f"Module {name} needs a source and an output")
+        self.source_path = manifest["source"]
+        self.output = manifest["output"]
+        self.address = manifest.get("address")
+        self.assembly = manifest.get("assembly")
+        self.export = manifest.get("export")
+        try:
+            with open(self.source_path, "r") as source_file:
+                self.source = source_file.read()
+        except OSError as error:
+            raise CompileError(f"{name}: {error}")
+        self.declarations, self.imports = scan(self.source)
+        self.is_main = manifest.get("main", not self.imports)
+        self.dependencies = {} # imported (kind, name) -> providing module name
+
+# The `data`, `global` and `routine` keywords only appear in declarations,
+# so the lexer alone finds what a module declares and imports without a
+# full parse
+def scan(source: str) -> tuple[set[tuple[str, str]], list[tuple[str, str]]]:
+    tokens = [token for token in StornLexer(InputStream(source)).getAllTokens() if token.channel == Token.DEFAULT_CHANNEL]
+    declarations = set()
+    imports = []
+    for i, token in enumerate(tokens[:-1]):
+        if token.text not in KINDS:
+            continue
+        declaration = (KINDS[token.text], tokens[i + 1].text)
+        if i > 0 and tokens[i - 1].text == "import":
+            imports.append(declaration)
+        else:
+            declarations.add(declaration)
+    return declarations, imports
+
+def resolve_dependencies(modules: dict[str, Module]):
+    providers = {}
+    for module in modules.values():
+        for declaration in module.declarations:
+            providers.setdefault(declaration, []).append(module.name)
+    for module in modules.values():
+        for kind, name in module.imports:
+            candidates = [provider for provider in providers.get((kind, name), []) if provider != module.name]
+            if not candidates:
+                raise CompileError(f"No module exports {kind} {name} (imported by {module.name})")
+            if len(candidates) > 1:
+                raise CompileError(f"{kind} {name} (imported by {module.name}) is exported by more than one module: {', '.join(candidates)}")
+            module.dependencies[(kind, name)] = candidates[0]
+
+def imports_for(module: Module, exports: dict[str, dict]) -> dict:
+    imports = {"globals": {}, "data": {}, "routines": {}}
+    for (kind, name), provider in module.dependencies.items():
+        imports[kind][name] = exports[provider][kind][name]
+    return imports
+
+def build_module(name, source, start_address, imports, is_main, render_assembly, optimise, cache_directory, cache_size, keep):
+    start = time.perf_counter()
+    removed = {}
+    try:
+        cache = BuildCache(cache_directory, cache_size) if cache_directory else None
+        program, assembly, exports = cached_compile(cache, source, start_address, imports, is_main, render_assembly, optimise, keep=keep, removed=removed)
+    except (CompileError, OSError) as error: # eg. an unwritable cache directory
+        raise CompileError(f"{name}: {error}")
+    return program, assembly, exports, time.perf_counter() - start, removed
+
+# Everything other modules import from `module`, which tree shaking keeps
+def imported_from(module: Module, modules: dict[str, Module]) -> list[str]:
+    return sorted({name for importer in modules.values() for (_, name), provider in importer.dependencies.items() if provider == module.name})
+
+# Modules are compiled as soon as every module they import from has been
+# compiled, since its exports carry the resolved routine addresses.
+# Tree shaking can remove any routine, since every importer is in the manifest
+def build(modules: dict[str, Module], jobs: int, optimise=False, cache_directory=None, cache_size=DEFAULT_MAX_SIZE, tree_shake=False) -> dict[str, tuple]:
+    results = {}
+    exports = {}
+    pending = dict(modules)
+
+    def ready() -> list[Module]:
+        modules = [module for module in pending.values() if all(provider in exports for provider in module.dependencies.values())]
+        for module in modules:
+            del pending[module.name]
+        return modules
+
+    def arguments(module: Module) -> tuple:
+        keep = imported_from(module, modules) if tree_shake else None
+        return (module.name, module.source, module.address, imports_for(module, exports), module.is_main, module.assembly is not None, optimise, cache_directory, cache_size, keep)
+
+    if jobs == 1:
+        while pending:
+            batch = ready()
+            if not batch:
+                raise CompileError(f"Circular imports between modules: {', '.join(pending)}")
+            for module in batch:
+                results[module.name] = build_module(*arguments(module))
+                exports[module.name] = results[module.name][2]
+        return results
+
+    with ProcessPoolExecutor(jobs) as executor:
+        running = {}
+        while pending or running:
+            for module in ready():
+                running[executor.submit(build_module, *arguments(module))] = module.name
+            if not running:
+                raise CompileError(f"Circular imports between modules: {', '.join(pending)}")
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                results[name] = future.result()
+                exports[name] = results[name][2]
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Storn build driver. Compiles every module in a project manifest, in parallel where imports allow")
+    parser.add_argument("manifest", help="Project manifest (YAML)")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="Modules to compile concurrently (default is the number of CPUs, 1 compiles serially in-process)")
+    parser.add_argument("-O", "--optimise", action="store_true", help="Optimise every module, as compile_storn.py -O")
+    parser.add_argument("-c", "--cache", help="Directory to cache compiled modules in, as compile_storn.py (no caching if omitted)")
+    parser.add_argument("--cache-size", type=int, default=DEFAULT_MAX_SIZE, help=f"Cache size in bytes (default {DEFAULT_MAX_SIZE})")
+    parser.add_argument("--tree-shake", action="store_true", help="Remove routines that neither entry nor another module calls, as compile_storn.py --tree-shake")
+    parser.add_argument("--size-report", action="store_true", help="Print what tree shaking removed from each module (not available on cache hits)")
+    args = parser.parse_args()
+
+    try:
+        start = time.perf_counter()
+        with open(args.manifest, "r") as manifest_file:
+            manifest = yaml.safe_load(manifest_file)
+        modules = {name: Module(name, module) for name, module in manifest["modules"].items()}
+        resolve_dependencies(modules)
+        results = build(modules, args.jobs, args.optimise, args.cache, args.cache_size, args.tree_shake)
+
+        for name, module in modules.items():
+            program, assembly, exports, _, _ = results[name]
+            try:
+                with open(module.output, "wb") as rom_file:
+                    rom_file.write(program)
+                if module.assembly:
+                    with open(module.assembly, "w") as assembly_file:
+                        assembly_file.write(assembly)
+                if module.export:
+                    SymbolTable.dump(exports, module.export)
+            except OSError as error:
+                raise CompileError(f"{name}: {error}")
+        wall_time = time.perf_counter() - start
+    except CompileError as error:
+        print("Compilation failed with error:", file=sys.stderr)
+        print(error, file=sys.stderr)
+        sys.exit(1)
+
+    for name, module in modules.items():
+        print(f"{name}: {module.output} ({len(results[name][0])} bytes, {results[name][3]:.2f}s)")
+        if args.size_report:
+            print_size_report(results[name][4], sys.stdout)
+    print(f"Built {len(modules)} modules in {wall_time:.2f}s (jobs: {args.jobs})")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+import sys
+import json
+import base64
+import socket
+import argparse
+
+# Deliberately only uses the standard library so that it starts quickly;
+# parsing and compilation happen in compile_server.py
+DEFAULT_SOCKET = "/tmp/storn_compile.sock"
+
+def request(socket_path: str, request: dict) -> dict:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(socket_path)
+        client.sendall(json.dumps(request).encode())
+        client.shutdown(socket.SHUT_WR)
+        response = b""
+        while chunk := client.recv(65536):
+            response += chunk
+    return json.loads(response)
+
+def main():
+    parser = argparse.ArgumentParser(description="Storn compile client. Compiles through a running compile_server.py")
+    parser.add_argument("input", nargs="?", help="Source file (or stdin if omitted)")
+    parser.add_argument("-o", "--output", help="Output file (or stdout if omitted)")
+    parser.add_argument("-s", "--assembly", help="File to write assembly to (no assembly written if omitted)")
+    parser.add_argument("-a", "--address", type=lambda x: int(x, 0), help="Address in memory to start program from. Used for label address resolution. Default (omission) places program at the end of memory")
+    parser.add_argument("-i", "--imports", help="File to read import data from, YAML or a .sym symbol table (no imports used if omitted)")
+    parser.add_argument("-e", "--export", help="File to write export data to, as a symbol table if it ends in .sym and YAML otherwise (no exports generated if omitted)")
+    parser.add_argument("-O", "--optimise", action="store_true", help="Run the peephole optimiser over the generated instructions")
+    parser.add_argument("--unroll-limit", type=int, help="Copies of up to this many bytes are unrolled rather than looped (server default if omitted)")
+    parser.add_argument("--inline-limit", type=int, help="Routines compiled to up to this many bytes are inlined (server default if omitted)")
+    parser.add_argument("--tree-shake", action="store_true", help="Remove routines that entry doesn't call, as compile_storn.py --tree-shake")
+    parser.add_argument("-k", "--keep", action="append", default=[], help="Routine or global another module imports, kept when tree shaking (repeatable)")
+    parser.add_argument("-V", "--vtx", action="store_true", help="Assemble Vtx instead of compiling Storn (as assemble_vtx.py)")
+    parser.add_argument("-p", "--parser", choices=["antlr", "fast"], default="antlr", help="Assembly parser when assembling Vtx")
+    parser.add_argument("-S", "--socket", default=DEFAULT_SOCKET, help=f"Unix socket of the compile server (default {DEFAULT_SOCKET})")
+    args = parser.parse_args()
+
+    if args.input:
+        with open(args.input, "r") as source_file:
+            source = source_file.read()
+    else:
+        source = sys.stdin.read()
+    imports = None
+    if args.imports:
+        with open(args.imports, "r") as import_file:
+            imports = import_file.read()
+
+    response = request(args.socket, {
+        "tool": "vtx" if args.vtx else "storn",
+        "source": source,
+        "address": args.address,
+        "imports": imports,
+        "assembly": args.assembly is not None,
+        "parser": args.parser,
+        "export_format": "symbols" if args.export and args.export.endswith(".sym") else "yaml",
+        "optimise": args.optimise,
+        "unroll_limit": args.unroll_limit,
+        "keep": args.keep if args.tree_shake else None,
+        "inline_limit": args.inline_limit,
+    })
+    if "error" in response:
+        print("Compilation failed with error:", file=sys.stderr)
+        print(response["error"], file=sys.stderr)
+        sys.exit(1)
+
+    if args.assembly and not args.vtx:
+        with open(args.assembly, "w") as assembly_file:
+            assembly_file.write(response["assembly"])
+
+    if args.export and not args.vtx:
+        with open(args.export, "w") as export_file:
+            export_file.write(response["exports"])
+
+    program = base64.b64decode(response["program"])
+    if args.output:
+        with open(args.output, "wb") as rom_file:
+            rom_file.write(program)
+    else:
+        sys.stdout.buffer.write(program)
+
+if __name__ == "__main__":
+    main()
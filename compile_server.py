@@ -0,0 +1,80 @@
+import os
+import sys
+import json
+import base64
+import argparse
+import socketserver
+import yaml
+
+import SymbolTable
+from CodeGenerator import CompileError, DEFAULT_UNROLL_LIMIT, DEFAULT_INLINE_LIMIT
+from compile_storn import compile
+from assemble_vtx import assemble
+
+DEFAULT_SOCKET = "/tmp/storn_compile.sock"
+WARMUP_PROGRAM = "routine entry () -> [0]\n{\n        output 1:8 + 1:8.\n        return.\n}\n"
+
+# Requests and responses are single JSON objects. The client writes its
+# request and shuts down its side of the connection; the server replies
+# and closes.
+# Request:  {"tool": "storn" | "vtx", "source": str, "address": int | None,
+#            "imports": str | None (YAML or symbol table), "assembly": bool,
+#            "parser": str, "export_format": "yaml" | "symbols", "optimise": bool,
+#            "unroll_limit": int | None, "keep": list[str] | None (tree shake if a list),
+#            "inline_limit": int | None}
+# Response: {"program": base64 str, "assembly": str | None, "exports": str}
+#           or {"error": str} on compile error
+def handle(request: dict) -> dict:
+    if request["tool"] == "vtx":
+        program = assemble(request["source"], False, request["address"], request.get("parser", "antlr"))
+        return {"program": base64.b64encode(program).decode()}
+    if request["imports"] is not None:
+        imports = SymbolTable.loads(request["imports"])
+    else:
+        imports = {"globals": {}, "data": {}, "routines": {}}
+    unroll_limit = request.get("unroll_limit")
+    if unroll_limit is None:
+        unroll_limit = DEFAULT_UNROLL_LIMIT
+    inline_limit = request.get("inline_limit")
+    if inline_limit is None:
+        inline_limit = DEFAULT_INLINE_LIMIT
+    program, assembly, exports = compile(request["source"], False, request["address"], imports, request["imports"] is None, request["assembly"], request.get("optimise", False), None, unroll_limit, request.get("keep"), None, inline_limit)
+    return {
+        "program": base64.b64encode(program).decode(),
+        "assembly": assembly,
+        "exports": SymbolTable.dumps(exports) if request.get("export_format") == "symbols" else yaml.dump(exports),
+    }
+
+class CompileHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        request = json.loads(self.rfile.read())
+        try:
+            response = handle(request)
+        except CompileError as error:
+            response = {"error": str(error)}
+        except Exception as exception:
+            response = {"error": f"Unexpected exception: {exception!r}"}
+        self.wfile.write(json.dumps(response).encode())
+
+def main():
+    parser = argparse.ArgumentParser(description="Storn compile server. Keeps the Storn and Vtx parsers warm between compiles")
+    parser.add_argument("-S", "--socket", default=DEFAULT_SOCKET, help=f"Unix socket to listen on (default {DEFAULT_SOCKET})")
+    args = parser.parse_args()
+
+    # ANTLR deserializes each parser's ATN on import and caches its DFA
+    # across parses, so one compile warms both front ends
+    handle({"tool": "storn", "source": WARMUP_PROGRAM, "address": None, "imports": None, "assembly": True})
+
+    if os.path.exists(args.socket):
+        os.remove(args.socket)
+    with socketserver.UnixStreamServer(args.socket, CompileHandler) as server:
+        print(f"Listening on {args.socket}", file=sys.stderr)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.remove(args.socket)
+
+if __name__ == "__main__":
+    main()
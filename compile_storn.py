@@ -1,18 +1,26 @@
 import sys
 import argparse
-import yaml
+from collections import Counter
 
 from antlr4 import FileStream, InputStream, CommonTokenStream
 
 from storn.StornLexer import StornLexer
 from storn.StornParser import StornParser
-from CodeGenerator import CodeGenerator, CompileError
+from CodeGenerator import CodeGenerator, CompileError, DEFAULT_UNROLL_LIMIT, DEFAULT_INLINE_LIMIT
 
-from vtx.VtxLexer import VtxLexer
-from vtx.VtxParser import VtxParser
-from Assembler import Assembler
+from Assembler import Assembler, format_lines, line_size
+from PeepholeOptimiser import PeepholeOptimiser
+import SymbolTable
+import Runtime
+from BuildCache import BuildCache, DEFAULT_CACHE_DIRECTORY, DEFAULT_MAX_SIZE
 
-def compile(source, is_file, start_address, imports, is_main):
+# The generator's instructions are assembled directly, without rendering
+# and re-parsing them as text. Assembly is only rendered if requested.
+# Optimisation hit counts are added to `stats` if given.
+# Routines that can't be reached from `entry` or the routines in `keep`
+# (those other modules import) are removed if `keep` isn't None, and the
+# sizes in bytes of what was removed are added to `removed` if given
+def compile(source, is_file, start_address, imports, is_main, render_assembly=True, optimise=False, stats=None, unroll_limit=DEFAULT_UNROLL_LIMIT, keep=None, removed=None, inline_limit=DEFAULT_INLINE_LIMIT):
     exports = {"globals": {}, "data": {}, "routines": {}}
 
     storn_input = FileStream(source) if is_file else InputStream(source)
@@ -22,50 +30,107 @@ def compile(source, is_file, start_address, imports, is_main):
     storn_tree = storn_parser.program()
     if storn_parser.getNumberOfSyntaxErrors() > 0:
         raise CompileError("Failed to parse")
-    generator = CodeGenerator(imports, exports, is_main)
+    generator = CodeGenerator(imports, exports, is_main, unroll_limit, inline_limit)
     generator.visit(storn_tree)
+    if keep is not None:
+        runtime_routines = generator.runtime_routines
+        removed_routines, removed_globals = generator.eliminate_dead_code(set(keep))
+        # Runtime routines only dead routines called aren't linked at all
+        for name in sorted(runtime_routines - generator.runtime_routines, key=list(Runtime.ROUTINES).index):
+            removed_routines[Runtime.ROUTINES[name][0]] = Runtime.load()[name]
+        if removed is not None:
+            removed.setdefault("routines", {}).update({name: sum(line_size(line) for line in lines) for name, lines in removed_routines.items()})
+            removed.setdefault("globals", {}).update({name: type_.size for name, type_ in removed_globals.items()})
+    if optimise:
+        generator.instructions = PeepholeOptimiser(stats).optimise(generator.instructions)
+    # The runtime library is hand-optimised, so it's linked afterwards
+    generator.instructions += Runtime.link(generator.runtime_routines)
 
-    assembly = "\n".join(generator.instructions) + "\n"
-    vtx_input = InputStream(assembly)
-    vtx_lexer = VtxLexer(vtx_input)
-    vtx_stream = CommonTokenStream(vtx_lexer)
-    vtx_parser = VtxParser(vtx_stream)
-    vtx_tree = vtx_parser.program()
     assembler = Assembler(imports, exports, start_address)
-    assembler.visit(vtx_tree)
+    assembler.assemble(generator.instructions)
+    assembly = format_lines(generator.instructions) if render_assembly else None
 
     return bytearray(assembler.instructions), assembly, exports
 
+# Compiles through `cache` if there is one. Cache entries always hold the assembly
+def cached_compile(cache, source, start_address, imports, is_main, render_assembly=True, optimise=False, stats=None, unroll_limit=DEFAULT_UNROLL_LIMIT, keep=None, removed=None, inline_limit=DEFAULT_INLINE_LIMIT):
+    if cache is None:
+        return compile(source, False, start_address, imports, is_main, render_assembly, optimise, stats, unroll_limit, keep, removed, inline_limit)
+    key = cache.key(source, imports, start_address, is_main, {"optimise": optimise, "unroll_limit": unroll_limit, "keep": None if keep is None else sorted(keep), "inline_limit": inline_limit})
+    cached = cache.get(key)
+    if cached:
+        return cached
+    program, assembly, exports = compile(source, False, start_address, imports, is_main, True, optimise, stats, unroll_limit, keep, removed, inline_limit)
+    cache.put(key, program, assembly, exports)
+    return program, assembly, exports
+
+# What tree shaking removed, eg.
+#   removed routine unused: 42 bytes
+#   removed global table: 16 bytes (RAM, no longer exported)
+#   removed 42 bytes of code
+def print_size_report(removed, file):
+    for name, size in removed.get("routines", {}).items():
+        print(f"removed routine {name}: {size} bytes", file=file)
+    for name, size in removed.get("globals", {}).items():
+        print(f"removed global {name}: {size} bytes (RAM, no longer exported)", file=file)
+    print(f"removed {sum(removed.get('routines', {}).values())} bytes of code", file=file)
+
 def main():
     parser = argparse.ArgumentParser(description="Storn Compiler")
     parser.add_argument("input", nargs="?", help="Source file (or stdin if omitted)")
     parser.add_argument("-o", "--output", help="Output file (or stdout if omitted)")
     parser.add_argument("-s", "--assembly", help="File to write assembly to (no assembly written if omitted)")
     parser.add_argument("-a", "--address", type=lambda x: int(x, 0), help="Address in memory to start program from. Used for label address resolution. Default (omission) places program at the end of memory")
-    parser.add_argument("-i", "--imports", help="File to read import data from (no imports used if omitted)") # this is plural because `args.import` doesn't parse
-    parser.add_argument("-e", "--export", help="File to write export data to (no exports generated if omitted)")
+    parser.add_argument("-i", "--imports", help="File to read import data from, YAML or a .sym symbol table (no imports used if omitted)") # this is plural because `args.import` doesn't parse
+    parser.add_argument("-e", "--export", help="File to write export data to, as a symbol table if it ends in .sym and YAML otherwise (no exports generated if omitted)")
+    parser.add_argument("-O", "--optimise", action="store_true", help="Run the peephole optimiser over the generated instructions")
+    parser.add_argument("--unroll-limit", type=int, default=DEFAULT_UNROLL_LIMIT, help=f"Copies of up to this many bytes are unrolled rather than looped (default {DEFAULT_UNROLL_LIMIT})")
+    parser.add_argument("--inline-limit", type=int, default=DEFAULT_INLINE_LIMIT, help=f"Calls to routines compiled to up to this many bytes are replaced by their bodies (default {DEFAULT_INLINE_LIMIT}, 0 never inlines)")
+    parser.add_argument("--tree-shake", action="store_true", help="Remove routines that entry doesn't call, directly or indirectly, and stop exporting globals they don't use")
+    parser.add_argument("-k", "--keep", action="append", default=[], help="Routine or global another module imports, kept when tree shaking (repeatable)")
+    parser.add_argument("--size-report", action="store_true", help="Print the size in bytes of each routine and global removed by tree shaking to stderr (not available on cache hits)")
+    parser.add_argument("--optimise-stats", action="store_true", help="Print how often each optimisation applied to stderr (not available on cache hits)")
+    parser.add_argument("-c", "--cache", help=f"Directory to cache compiled modules in, eg. {DEFAULT_CACHE_DIRECTORY} (no caching if omitted)")
+    parser.add_argument("--cache-size", type=int, default=DEFAULT_MAX_SIZE, help=f"Cache size in bytes above which least recently used entries are evicted (default {DEFAULT_MAX_SIZE})")
+    parser.add_argument("--cache-stats", action="store_true", help="Print hit/miss statistics for the cache directory and exit")
     args = parser.parse_args()
 
+    if args.cache_stats:
+        cache = BuildCache(args.cache or DEFAULT_CACHE_DIRECTORY, args.cache_size)
+        for name, value in cache.stats().items():
+            print(f"{name}: {value}")
+        return
+
     try:
         if args.imports:
-            with open(args.imports, "r") as import_file:
-                imports = yaml.safe_load(import_file)
+            imports = SymbolTable.load(args.imports)
         else:
             imports = {"globals": {}, "data": {}, "routines": {}}
 
         if args.input:
-            program, assembly, exports = compile(args.input, True, args.address, imports, args.imports is None)
+            with open(args.input, "r") as source_file:
+                source = source_file.read()
         else:
             source = sys.stdin.read()
-            program, assembly, exports = compile(source, False, args.address, imports, args.imports is None)
+        is_main = args.imports is None
+
+        cache = BuildCache(args.cache, args.cache_size) if args.cache else None
+        stats = Counter()
+        removed = {}
+        keep = args.keep if args.tree_shake else None
+        program, assembly, exports = cached_compile(cache, source, args.address, imports, is_main, args.assembly is not None, args.optimise, stats, args.unroll_limit, keep, removed, args.inline_limit)
+        if args.optimise_stats:
+            for name, hits in sorted(stats.items()):
+                print(f"{name}: {hits}", file=sys.stderr)
+        if args.size_report:
+            print_size_report(removed, sys.stderr)
 
         if args.assembly:
             with open(args.assembly, "w") as assembly_file:
                 assembly_file.write(assembly)
 
         if args.export:
-            with open(args.export, "w") as export_file:
-                yaml.dump(exports, export_file)
+            SymbolTable.dump(exports, args.export)
 
         if args.output:
             with open(args.output, "wb") as rom_file:
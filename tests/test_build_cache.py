@@ -0,0 +1,56 @@
+import glob
+import subprocess
+import yaml
+
+def compile(program, cache_directory, *flags):
+    return subprocess.run(
+        ["python", "compile_storn.py", f"tests/storn/{program}.stn", "-c", cache_directory, *flags],
+        check=True,
+        stdout=subprocess.PIPE,
+    ).stdout
+
+def stats(cache_directory, *flags):
+    output = subprocess.run(
+        ["python", "compile_storn.py", "-c", cache_directory, "--cache-stats", *flags],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    return {name: int(value) for name, value in (line.split(": ") for line in output.splitlines())}
+
+def test_build_cache_hit(tmp_path):
+    cache_directory = str(tmp_path)
+    uncached = subprocess.run(["python", "compile_storn.py", "tests/storn/call.stn"], check=True, stdout=subprocess.PIPE).stdout
+    assert compile("call", cache_directory) == uncached
+    assert compile("call", cache_directory) == uncached
+    assert stats(cache_directory)["hits"] == 1
+    assert stats(cache_directory)["misses"] == 1
+
+def test_build_cache_key(tmp_path):
+    cache_directory = str(tmp_path)
+    compile("call", cache_directory)
+    compile("call", cache_directory, "-a", "0x1000")
+    compile("recursion", cache_directory)
+    assert stats(cache_directory)["misses"] == 3
+    assert stats(cache_directory)["entries"] == 3
+
+def test_build_cache_eviction(tmp_path):
+    cache_directory = str(tmp_path)
+    compile("call", cache_directory, "--cache-size", "1")
+    compile("recursion", cache_directory, "--cache-size", "1")
+    cache_stats = stats(cache_directory)
+    assert cache_stats["entries"] == 0
+    assert cache_stats["evictions"] == 2
+
+# Modules compiled concurrently share the cache, and every lookup counts
+def test_build_cache_parallel(tmp_path):
+    cache_directory = str(tmp_path / "cache")
+    programs = sorted(glob.glob("tests/storn/*.stn"))
+    manifest = tmp_path / "manifest.yaml"
+    manifest.write_text(yaml.dump({"modules": {f"module{i}": {"source": program, "output": str(tmp_path / f"module{i}")} for i, program in enumerate(programs)}}))
+    for _ in range(2):
+        subprocess.run(["python", "build_storn.py", str(manifest), "-j", "8", "-c", cache_directory], check=True, capture_output=True)
+    cache_stats = stats(cache_directory)
+    assert cache_stats["misses"] == len(programs)
+    assert cache_stats["hits"] == len(programs)
+    assert cache_stats["entries"] == len(programs)
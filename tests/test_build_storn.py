@@ -0,0 +1,50 @@
+import subprocess
+import yaml
+
+def build(tmp_path, modules, *flags):
+    manifest = tmp_path / "manifest.yaml"
+    manifest.write_text(yaml.dump({"modules": modules}))
+    return subprocess.run(["python", "build_storn.py", str(manifest), *flags], capture_output=True, text=True)
+
+def network_modules(tmp_path):
+    return {
+        "network_main": {"source": "peripherals/network_main.stn", "output": str(tmp_path / "network_main")},
+        "network_handler": {"source": "peripherals/network_handler.stn", "output": str(tmp_path / "network_handler"), "address": 0x410},
+    }
+
+def test_build_matches_compile_storn(tmp_path):
+    exports = str(tmp_path / "exports.yaml")
+    main_rom = subprocess.run(["python", "compile_storn.py", "peripherals/network_main.stn", "-e", exports], check=True, stdout=subprocess.PIPE).stdout
+    handler_rom = subprocess.run(["python", "compile_storn.py", "peripherals/network_handler.stn", "-i", exports, "-a", "0x410"], check=True, stdout=subprocess.PIPE).stdout
+    for jobs in ["1", "2"]:
+        result = build(tmp_path, network_modules(tmp_path), "-j", jobs)
+        assert result.returncode == 0, result.stderr
+        assert (tmp_path / "network_main").read_bytes() == main_rom
+        assert (tmp_path / "network_handler").read_bytes() == handler_rom
+
+def test_build_missing_export(tmp_path):
+    modules = network_modules(tmp_path)
+    del modules["network_main"]
+    result = build(tmp_path, modules)
+    assert result.returncode == 1
+    assert "No module exports routines output_packet" in result.stderr
+
+# The handler imports output_packet, so tree shaking has nothing to remove
+def test_build_tree_shake(tmp_path):
+    result = build(tmp_path, network_modules(tmp_path), "-j", "1")
+    assert result.returncode == 0, result.stderr
+    roms = [(tmp_path / name).read_bytes() for name in ["network_main", "network_handler"]]
+    result = build(tmp_path, network_modules(tmp_path), "-j", "1", "--tree-shake", "--size-report")
+    assert result.returncode == 0, result.stderr
+    assert [(tmp_path / name).read_bytes() for name in ["network_main", "network_handler"]] == roms
+    assert result.stdout.count("removed 0 bytes of code") == 2
+
+# An I/O error in a worker fails the module it was building
+def test_build_io_error(tmp_path):
+    cache_file = tmp_path / "cache"
+    cache_file.write_text("")
+    for jobs in ["1", "2"]:
+        result = build(tmp_path, network_modules(tmp_path), "-j", jobs, "-c", str(cache_file))
+        assert result.returncode == 1
+        assert "network_main: [Errno 17] File exists" in result.stderr
+        assert "Traceback" not in result.stderr
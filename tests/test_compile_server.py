@@ -0,0 +1,42 @@
+import os
+import time
+import subprocess
+import pytest
+
+programs = ["call", "recursion", "8/comparative", "16/shift", "data/projection"]
+
+@pytest.fixture(scope="module")
+def server_socket(tmp_path_factory):
+    socket_path = str(tmp_path_factory.mktemp("server") / "compile.sock")
+    server = subprocess.Popen(["python", "compile_server.py", "-S", socket_path], stderr=subprocess.DEVNULL)
+    for _ in range(100):
+        if os.path.exists(socket_path):
+            break
+        time.sleep(0.1)
+    yield socket_path
+    server.terminate()
+    server.wait()
+
+def run(command):
+    return subprocess.run(command, check=True, stdout=subprocess.PIPE).stdout
+
+@pytest.mark.parametrize("program", programs)
+def test_compile_server(server_socket, program):
+    program_path = f"tests/storn/{program}.stn"
+    expected = run(["python", "compile_storn.py", program_path])
+    assert run(["python", "compile_client.py", program_path, "-S", server_socket]) == expected, f"Server output differs for {program}"
+
+def test_compile_server_vtx(server_socket):
+    program_path = "tests/vtx/multiplication.vtx"
+    expected = run(["python", "assemble_vtx.py", program_path])
+    assert run(["python", "compile_client.py", program_path, "--vtx", "-S", server_socket]) == expected
+
+def test_compile_server_error(server_socket):
+    result = subprocess.run(
+        ["python", "compile_client.py", "-S", server_socket],
+        input="routine entry () -> [0] x: [8]. { x = 1:16. return. }",
+        capture_output=True,
+        text=True,
+    )
+    assert result.returncode == 1
+    assert "lvalue and expression are of different types" in result.stderr
@@ -0,0 +1,30 @@
+import glob
+import subprocess
+import pytest
+
+vtx_programs = sorted(glob.glob("tests/vtx/*.vtx"))
+storn_programs = sorted(glob.glob("tests/storn/**/*.stn", recursive=True) + glob.glob("examples/*.stn"))
+
+def run(script, program, parser_name):
+    return subprocess.run(
+        ["python", script, program, "--parser", parser_name],
+        check=True,
+        stdout=subprocess.PIPE,
+    ).stdout
+
+@pytest.mark.parametrize("program", vtx_programs)
+def test_fast_vtx_assembly(program):
+    assert run("assemble_vtx.py", program, "fast") == run("assemble_vtx.py", program, "antlr"), f"Fast parser output differs for {program}"
+
+# The compiler assembles its instructions in memory, so the rendered
+# assembly must re-assemble to the same ROM with either parser
+@pytest.mark.parametrize("program", storn_programs)
+def test_fast_vtx_compiler_output(program, tmp_path):
+    assembly_path = str(tmp_path / "assembly.vtx")
+    rom = subprocess.run(
+        ["python", "compile_storn.py", program, "-s", assembly_path],
+        check=True,
+        stdout=subprocess.PIPE,
+    ).stdout
+    assert run("assemble_vtx.py", assembly_path, "antlr") == rom, f"ANTLR parser output differs for {program}"
+    assert run("assemble_vtx.py", assembly_path, "fast") == rom, f"Fast parser output differs for {program}"
@@ -0,0 +1,55 @@
+import subprocess
+from collections import Counter
+from Assembler import Label
+from PeepholeOptimiser import PeepholeOptimiser
+
+def test_peephole_stats():
+    result = subprocess.run(
+        ["python", "compile_storn.py", "examples/factorial.stn", "-O", "--optimise-stats", "-o", "/dev/null"],
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    stats = {name: int(hits) for name, hits in (line.split(": ") for line in result.stderr.splitlines())}
+    assert stats["unreachable"] > 0
+
+# The generator branches on `if` conditions directly, but a comparison
+# materialised then tested still collapses to one jump
+def test_peephole_materialised_condition():
+    lines = [
+        ("ldr", "a", "b"), ("sub", "c"), ("jmp", "sf", "L0"), ("ldr", "b", 0), ("jmp", "L1"),
+        Label("L0"), ("ldr", "b", 1), Label("L1"), ("ldr", "a", "b"), ("jmp", "zf", "L2"),
+        ("ldr", "a", 200), ("out",), Label("L2"), ("hlt",),
+    ]
+    stats = Counter()
+    assert PeepholeOptimiser(stats).optimise(lines) == [("ldr", "a", "b"), ("sub", "c"), ("jmp", "nsf", "L2"), ("ldr", "a", 200), ("out",), Label("L2"), ("hlt",)]
+    assert stats["materialised_condition"] == 1
+
+def test_peephole_push_pop():
+    lines = [("psh", 1), ("pop", "b"), ("psh", "a"), ("ldr", "c", 2), ("pop", "a"), ("out",), ("psh", "b"), ("psh", "c"), ("hlt",)]
+    assert PeepholeOptimiser().optimise(lines) == [("ldr", "b", 1), ("ldr", "c", 2), ("out",), ("psh", "b"), ("psh", "c"), ("hlt",)]
+
+# A push and pop either side of a label don't pair up, since the label can
+# be reached with a different stack
+def test_peephole_label_boundary():
+    lines = [("psh", 1), Label("L0"), ("pop", "b"), ("psh", "b"), ("jmp", "L0")]
+    assert PeepholeOptimiser().optimise(lines) == lines
+
+# Results are returned in BC, so only loads into other registers are dead
+# at a return
+def test_peephole_return_registers():
+    lines = [("ldr", "c", "b"), ("ldr", "a", 1), ("pop", "l"), ("pop", "h"), ("jmp", "m")]
+    assert PeepholeOptimiser().optimise(lines) == [("ldr", "c", "b"), ("pop", "l"), ("pop", "h"), ("jmp", "m")]
+
+# A branch to a jump goes straight to the jump's target, adjacent labels
+# become one, and a loop only reachable from itself is removed
+def test_peephole_jump_threading():
+    lines = [
+        ("jmp", "zf", "L0"), ("ldr", "a", 1), ("out",), ("jmp", "L1"),
+        Label("L2"), ("jmp", "L2"),
+        Label("L0"), ("jmp", "L3"),
+        Label("L1"), Label("L3"), ("hlt",),
+    ]
+    stats = Counter()
+    assert PeepholeOptimiser(stats).optimise(lines) == [("jmp", "zf", "L1"), ("ldr", "a", 1), ("out",), Label("L1"), ("hlt",)]
+    assert stats["jumps_removed"] == 3
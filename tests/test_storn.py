@@ -1,3 +1,4 @@
+import os
 import subprocess
 import pytest
 import yaml
@@ -5,14 +6,23 @@ import yaml
 with open("tests/storn_test_cases.yaml", "r") as file:
     test_cases = yaml.safe_load(file)
 
-def run_storn_test(program_name):
+# Every program is also run with optimisations enabled, and with every
+# fixed-size copy compiled as a loop and every call left as a call
+compile_flags = {"default": [], "optimised": ["-O"], "looped": ["--unroll-limit", "0", "--inline-limit", "0"]}
+# The VM's RAM persists between runs in this file; some programs read
+# uninitialised memory, so each starts from zeroed RAM
+RAM_SHM_FILENAME = "/tmp/vtx_ram_shm"
+
+def run_storn_test(program_name, flags):
     program_path = f"tests/storn/{program_name}.stn"
     rom_path = "roms/test"
     subprocess.run(
-        ["python", "compile_storn.py", program_path, "-o", rom_path],
+        ["python", "compile_storn.py", program_path, "-o", rom_path, *flags],
         check=True,
         stdout=subprocess.PIPE,
     )
+    if os.path.exists(RAM_SHM_FILENAME):
+        os.remove(RAM_SHM_FILENAME)
     result = subprocess.run(
         ["./out/vertex", "roms/control", rom_path],
         capture_output=True,
@@ -21,12 +31,85 @@ def run_storn_test(program_name):
     )
     return result.stdout + result.stderr
 
+@pytest.mark.parametrize("flags", compile_flags.values(), ids=compile_flags.keys())
 @pytest.mark.parametrize("test_case", test_cases, ids=[tc["program"] for tc in test_cases])
-def test_storn(test_case):
+def test_storn(test_case, flags):
     program = test_case["program"]
     expected_outputs = test_case["expected_output"]
     if isinstance(expected_outputs, str):
         expected_outputs = [expected_outputs]
-    output = run_storn_test(program)
+    output = run_storn_test(program, flags)
     for expected_output in expected_outputs:
         assert expected_output in output, f"Test {program} failed!"
+
+def test_tree_shake():
+    untouched = subprocess.run(["python", "compile_storn.py", "tests/storn/dead_code.stn", "--inline-limit", "0"], check=True, stdout=subprocess.PIPE).stdout
+    result = subprocess.run(
+        ["python", "compile_storn.py", "tests/storn/dead_code.stn", "--inline-limit", "0", "--tree-shake", "--size-report"],
+        check=True,
+        capture_output=True,
+    )
+    report = result.stderr.decode().splitlines()
+    assert report[:3] == ["removed routine product: 46 bytes", "removed routine unreachable: 7 bytes", "removed routine __mul8: 33 bytes"]
+    assert report[3].startswith("removed global scratch") and report[4].startswith("removed global unused")
+    assert report[5] == f"removed {len(untouched) - len(result.stdout)} bytes of code"
+    assert "OUTPUT: 210" in run_storn_test("dead_code", ["--tree-shake", "-O"])
+
+def test_inline(tmp_path):
+    calls = {}
+    for limit in ["0", "80"]:
+        assembly = tmp_path / "inline.vtx"
+        subprocess.run(["python", "compile_storn.py", "tests/storn/inline.stn", "-o", "/dev/null", "-s", str(assembly), "--inline-limit", limit], check=True)
+        calls[limit] = {line for line in assembly.read_text().splitlines() if line.startswith("cal ")}
+    assert calls["0"] == {"cal count", "cal first", "cal clamp", "cal sum", "cal twice", "cal find"}
+    assert calls["80"] == {"cal find"}
+
+def test_tail_call(tmp_path):
+    assembly = tmp_path / "tail_call.vtx"
+    subprocess.run(["python", "compile_storn.py", "tests/storn/tail_call.stn", "-o", "/dev/null", "-s", str(assembly)], check=True)
+    lines = assembly.read_text().splitlines()
+    assert lines.count("cal count") == 1 and lines.count("jmp count") == 1
+    assert lines.count("cal gcd") == 1 and lines.count("jmp gcd") == 1
+
+def test_frame(tmp_path):
+    assembly = tmp_path / "frame.vtx"
+    subprocess.run(["python", "compile_storn.py", "tests/storn/frame.stn", "-o", "/dev/null", "-s", str(assembly), "--inline-limit", "0"], check=True)
+    routines = {}
+    name = None
+    for line in assembly.read_text().splitlines():
+        if line.endswith(":") and not line.startswith("_"):
+            name = line[:-1]
+        else:
+            routines.setdefault(name, []).append(line)
+    assert routines["bump"] == ["cal tick", "jmp tick"]
+    assert "psh bph" not in routines["tick"]
+    assert "psh bph" in routines["total3"] and "ldr spl a" not in routines["total3"] and "ldr spl bpl" not in routines["total3"]
+
+def test_register_calls(tmp_path):
+    library = tmp_path / "library.stn"
+    library.write_text("routine twice (x: [16]) -> [16]\n{\n        return x + x.\n}\n\nroutine entry () -> [0]\n{\n        return.\n}\n")
+    handler = tmp_path / "handler.stn"
+    handler.write_text("import routine twice.\n\nroutine entry () -> [0]\n{\n        output [8]!twice(5:16).\n        return.\n}\n")
+    exports = tmp_path / "exports.yaml"
+    assembly = tmp_path / "handler.vtx"
+    subprocess.run(["python", "compile_storn.py", str(library), "-o", "/dev/null", "-e", str(exports)], check=True)
+    assert yaml.safe_load(exports.read_text())["routines"]["twice"]["registers"]
+    subprocess.run(["python", "compile_storn.py", str(handler), "-o", "/dev/null", "-i", str(exports), "-a", "0x410", "-s", str(assembly)], check=True)
+    lines = assembly.read_text().splitlines()
+    call = lines.index("cal twice")
+    assert lines[call - 2:call + 3] == ["ldr b 0", "ldr c 5", "cal twice", "ldr a c", "out"]
+
+def test_interrupt_saves(tmp_path):
+    main = tmp_path / "main.stn"
+    main.write_text("global ticks: [8].\n\nroutine entry () -> [0]\n{\n        ticks = 0:8.\n        return.\n}\n")
+    handler = tmp_path / "handler.stn"
+    handler.write_text("import global ticks.\n\nroutine bump () -> [0]\n{\n        ticks = ticks + 1:8.\n        return.\n}\n\nroutine entry () -> [0]\n{\n        !bump().\n        return.\n}\n")
+    exports = tmp_path / "exports.yaml"
+    assembly = tmp_path / "handler.vtx"
+    subprocess.run(["python", "compile_storn.py", str(main), "-o", "/dev/null", "-e", str(exports)], check=True)
+    subprocess.run(["python", "compile_storn.py", str(handler), "-o", "/dev/null", "-i", str(exports), "-a", "0x410", "-s", str(assembly), "--inline-limit", "0"], check=True)
+    lines = assembly.read_text().splitlines()
+    entry = lines.index("entry:")
+    # bump leaves C alone and BP is never set up, so neither is saved
+    assert lines[entry + 1:entry + 7] == ["psh s", "psh a", "psh b", "psh h", "psh l", "cal bump"]
+    assert lines[-6:] == ["pop l", "pop h", "pop b", "pop a", "pop s", "irt"]
@@ -0,0 +1,24 @@
+import subprocess
+import yaml
+import SymbolTable
+
+def compile_network(tmp_path, export_name):
+    exports = str(tmp_path / export_name)
+    subprocess.run(["python", "compile_storn.py", "peripherals/network_main.stn", "-e", exports, "-o", "/dev/null"], check=True)
+    handler_rom = subprocess.run(["python", "compile_storn.py", "peripherals/network_handler.stn", "-i", exports, "-a", "0x410"], check=True, stdout=subprocess.PIPE).stdout
+    return exports, handler_rom
+
+def test_symbol_table_matches_yaml(tmp_path):
+    yaml_path, yaml_rom = compile_network(tmp_path, "exports.yaml")
+    symbols_path, symbols_rom = compile_network(tmp_path, "exports.sym")
+    assert symbols_rom == yaml_rom
+    with open(yaml_path, "r") as yaml_file:
+        assert yaml.safe_load(yaml_file) == {section: dict(entries) for section, entries in SymbolTable.load(symbols_path).items()}
+
+def test_symbol_table_lazy_decode():
+    routine = {"parameters": {}, "return_type": {"type_": {"BaseType": {"width": 0}}}, "address": 1024}
+    exports = {"globals": {}, "data": {}, "routines": {f"routine_{i}": dict(routine, address=i) for i in range(100)}}
+    symbols = SymbolTable.loads(SymbolTable.dumps(exports))
+    assert "routine_42" in symbols["routines"]
+    assert symbols["routines"]["routine_42"]["address"] == 42
+    assert list(symbols["routines"].decoded) == ["routine_42"]
@@ -641,13 +641,16 @@ int main(int argc, char **argv)
     // Execute until halt
     logMessage(LOG_LEVEL_INFO, "Initialisation complete. Starting execution:");
     executionStage = EXEC_STAGE_RUN;
+    uint64_t cycles = 0; // one per microinstruction
     while (!((cpu.controlBus >> CTRL_HALT) & 0b1))
     {
         tick(&cpu);
         tock(&cpu);
+        cycles++;
     }
     executionStage = EXEC_STAGE_HALT;
     logMessage(LOG_LEVEL_INFO, "Program halted.");
+    logMessage(LOG_LEVEL_INFO, "Cycles: %llu", (unsigned long long)cycles);
 
     munmap((void *)cpu.ram, RAM_SIZE);
     munmap((void *)cpu.interruptState, sizeof(InterruptState));